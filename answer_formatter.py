@@ -0,0 +1,96 @@
+import datetime
+import decimal
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Local rendering of the answer formats spelled out in response_prompt_template.
+# Results whose shape is not recognized return None and are sent to the LLM instead.
+NUMERIC_TYPES = (int, float, decimal.Decimal)
+MISSING_LABEL = "N/A"
+# Measure columns that hold a plain cost sum; ratios such as cost per unit are left to the LLM
+COST_COLUMNS = {"total_cost", "total_billed_cost", "cost", "sum(billedcost)"}
+# Context filters named in the answer subject, as (key, singular, plural) with the wording of the response prompt
+# ("the cost of the application X"); services, categories and providers are named by their value alone
+SUBJECT_FILTERS = [
+    ("service", "", ""),
+    ("category", "", ""),
+    ("provider", "", ""),
+    ("region", "the region ", "the regions "),
+    ("tag_application", "the application ", "the applications "),
+    ("tag_environment", "the environment ", "the environments "),
+    ("tag_business_unit", "the business unit ", "the business units "),
+]
+# Context keys describing the period rather than a filter
+PERIOD_KEYS = {"periods", "period_start", "period_end"}
+
+
+def _money(value):
+    return f"${float(value):,.2f}"
+
+
+def _month_name(value):
+    if isinstance(value, str):
+        value = datetime.datetime.strptime(value[:10], "%Y-%m-%d")
+    return value.strftime("%B %Y")
+
+
+def _label(value):
+    if value is None:
+        return MISSING_LABEL
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime("%m/%Y")
+    return str(value)
+
+
+def _subject(context):
+    # "" without filters; None when the context holds a filter the subject cannot name
+    named = {key for key, _, _ in SUBJECT_FILTERS}
+    if any(value for key, value in context.items() if key not in named and key not in PERIOD_KEYS):
+        return None
+    parts = []
+    for key, singular, plural in SUBJECT_FILTERS:
+        values = context.get(key) or []
+        if values:
+            parts.append((plural if len(values) > 1 else singular) + " and ".join(values))
+    return " for ".join(parts)
+
+
+def _is_numeric(value):
+    return value is None or (isinstance(value, NUMERIC_TYPES) and not isinstance(value, bool))
+
+
+def format_answer(question, rows, columns, context):
+    """Formats a SQL result as the final "A: ..." answer, or returns None when the shape is not recognized."""
+    if rows is None or not columns or columns[-1].lower() not in COST_COLUMNS:
+        return None
+    if not rows or all(all(v is None for v in row) for row in rows):
+        return "A: There is no data for this question."
+    width = len(rows[0])
+    if any(len(row) != width for row in rows) or not all(_is_numeric(row[-1]) for row in rows):
+        return None
+    # Only the last column may be a measure; everything before it must be a label
+    if width > 1 and any(isinstance(row[i], NUMERIC_TYPES) and not isinstance(row[i], bool) for row in rows for i in range(width - 1)):
+        return None
+    period = context.get('periods')
+    period_text = _month_name(period[0][0]) if period else None
+    subject = _subject(context)
+
+    if width == 1:
+        if len(rows) != 1 or subject is None:
+            return None
+        total = _money(rows[0][0] or 0)
+        if period_text:
+            return f"A: In {period_text}, the cost of {subject} was {total}." if subject else f"A: In {period_text}, the total cost was {total}."
+        start, end = context.get('period_start'), context.get('period_end')
+        if not start or not end:
+            return None
+        if subject:
+            return f"A: The total consumption of {subject} is {total} from {_month_name(start)} to {_month_name(end)} as per the database."
+        return f"A: The total cloud consumption from {_month_name(start)} to {_month_name(end)} is {total}."
+
+    items = "; ".join(f"{'/'.join(_label(v) for v in row[:-1])}: {_money(row[-1] or 0)}" for row in rows)
+    is_trend = all(isinstance(row[0], (datetime.date, datetime.datetime)) for row in rows) and width == 2
+    if period_text and not is_trend:
+        return f"A: {items} in {period_text}."
+    return f"A: {items}."
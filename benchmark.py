@@ -0,0 +1,410 @@
+import argparse
+import decimal
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import time
+from collections import Counter
+
+import duckdb
+
+os.environ.setdefault("OPENAI_API_KEY", "offline-benchmark")  # the stub model never calls the remote API
+
+import data_processing
+import langchain_query
+import rollups
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from query_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Offline benchmark of the question pipeline: a synthetic FOCUS dataset, a stub chat model replaying
+# recorded question -> SQL pairs, and a JSON report of per-stage latency, tokens and accuracy.
+DEFAULT_ROWS = 1_000_000
+DEFAULT_MONTHS = 12
+DEFAULT_SEED = 42
+DEFAULT_ITERATIONS = 5
+DEFAULT_WORKDIR = os.path.join(os.path.dirname(__file__), "benchmark_data")
+PERCENTILES = (50, 95, 99)
+START_DATE = "2024-01-01"
+
+# (ProviderName, ServiceCategory, ServiceName) combinations of the synthetic dataset
+SERVICES = [
+    ("AWS", "Compute", "Amazon Elastic Compute Cloud"),
+    ("AWS", "Storage", "Amazon Simple Storage Service"),
+    ("AWS", "Database", "Amazon Relational Database Service"),
+    ("AWS", "Networking", "Amazon Virtual Private Cloud"),
+    ("Microsoft", "Compute", "Microsoft Azure Virtual Machines"),
+    ("Microsoft", "Storage", "Storage Accounts"),
+    ("Google Cloud", "Compute", "Compute Engine"),
+    ("Google Cloud", "Storage", "Cloud Storage"),
+    ("Oracle", "Compute", "Oracle Cloud Infrastructure Compute"),
+    ("Oracle", "Database", "Autonomous Database"),
+]
+REGIONS = ["us-east-1", "us-west-2", "eu-west-1", "global"]
+RESOURCE_TYPES = ["Instance", "Bucket", "Database", "NAT Gateway"]
+APPLICATIONS = ["EvolveVaultCentral", "PaymentsAPI", "DataLake", "CustomerPortal", "Analytics", None]
+ENVIRONMENTS = ["prod", "dev", "staging", None]
+BUSINESS_UNITS = ["ChicagoIT", "Finance", "Marketing", None]
+
+# Recorded question -> SQL pairs used when no --cases file is given; the SQL is the expected answer.
+# An optional "formatter" ("local" or "llm") is the expected answer formatter of the case.
+DEFAULT_CASES = [
+    {"question": "What is the total cloud consumption?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing;", "formatter": "local"},
+    {"question": "What was the consumption in March 2024?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2024-03-01' AND BillingPeriodStart < '2024-04-01';", "formatter": "local"},
+    {"question": "What is the total consumption of Azure?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ProviderName = 'Microsoft';"},
+    {"question": "What was the cost of EC2 and S3?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName IN ('Amazon Elastic Compute Cloud', 'Amazon Simple Storage Service') GROUP BY ServiceName;"},
+    {"question": "Which cloud provider consumed the most?",
+     "sql": "SELECT ProviderName, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY ProviderName ORDER BY total_cost DESC LIMIT 1;"},
+    {"question": "What are the top 3 applications by cost?",
+     "sql": "SELECT tag_application, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY tag_application ORDER BY total_cost DESC LIMIT 3;"},
+    {"question": "Cost by application and environment",
+     "sql": "SELECT tag_application, tag_environment, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY tag_application, tag_environment ORDER BY total_cost DESC;"},
+    {"question": "What is the month-over-month consumption comparison?",
+     "sql": "SELECT date_trunc('month', BillingPeriodStart) AS month, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY date_trunc('month', BillingPeriodStart) ORDER BY month;"},
+    {"question": "Which resources cost the most in compute?",
+     "sql": "SELECT ResourceId, ResourceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceCategory = 'Compute' GROUP BY ResourceId, ResourceName ORDER BY total_cost DESC LIMIT 3;"},
+    {"question": "What is the cost per unit of storage?",
+     "sql": "SELECT ServiceCategory, SUM(BilledCost) / SUM(ConsumedQuantity) AS cost_per_unit FROM consolidated_billing WHERE ServiceCategory = 'Storage' GROUP BY ServiceCategory;"},
+    {"question": "What was the consumption in 2023?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2023-01-01' AND BillingPeriodStart < '2024-01-01';", "formatter": "llm"},
+    {"question": "What are the top 5 services in 2023?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2023-01-01' AND BillingPeriodStart < '2024-01-01' GROUP BY ServiceName ORDER BY total_cost DESC LIMIT 5;"},
+    {"question": "What was the cost of EC2 on 2024-01-15?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName = 'Amazon Elastic Compute Cloud' AND BillingPeriodStart >= '2024-01-15' AND BillingPeriodStart < '2024-01-16' GROUP BY ServiceName;"},
+    # Dimension words the template does not group or filter by: a single total would not answer them
+    {"question": "Which services were billed in january?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2024-01-01' AND BillingPeriodStart < '2024-02-01' GROUP BY ServiceName ORDER BY total_cost DESC;"},
+    {"question": "list services",
+     "sql": "SELECT DISTINCT ServiceName FROM consolidated_billing ORDER BY ServiceName;"},
+    {"question": "show me the services",
+     "sql": "SELECT DISTINCT ServiceName FROM consolidated_billing ORDER BY ServiceName;"},
+    {"question": "What services did we spend on?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY ServiceName ORDER BY total_cost DESC;"},
+    {"question": "cost of the region",
+     "sql": "SELECT RegionId, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY RegionId ORDER BY total_cost DESC;"},
+    # LLM SQL narrower than the question context: the local formatter would name only the context's filters
+    {"question": "What was the AWS consumption in Q1 2024?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ProviderName = 'AWS' AND BillingPeriodStart >= '2024-01-01' AND BillingPeriodStart < '2024-04-01';", "formatter": "llm"},
+    {"question": "What is the cost of AWS instances?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ProviderName = 'AWS' AND ResourceType = 'Instance';", "formatter": "llm"},
+    {"question": "What was the cost of resource res-1?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ResourceId = 'res-1';", "formatter": "llm"},
+]
+
+# Line items of one month, with a credit, on which rollups.route_query must give the raw scan's result
+ROLLUP_LINE_ITEMS = [10.004, -4.003, 5.004]
+ROLLUP_CASES = [
+    "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing;",
+    "SELECT SUM(COALESCE(BilledCost, 0)) AS total_cost FROM consolidated_billing;",
+    "SELECT ProviderName, ROUND(SUM(BilledCost), 2) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2024-01-01' AND BillingPeriodStart < '2024-02-01' GROUP BY ProviderName;",
+    "SELECT SUM(ABS(BilledCost)) AS total_cost FROM consolidated_billing;",
+    "SELECT SUM(CASE WHEN BilledCost > 0 THEN BilledCost ELSE 0 END) AS total_cost FROM consolidated_billing;",
+    "SELECT SUM(ROUND(BilledCost, 2)) AS total_cost FROM consolidated_billing;",
+    "SELECT SUM(NULLIF(BilledCost, -4.003)) AS total_cost FROM consolidated_billing;",
+    "SELECT SUM(BilledCost * 1.1) AS total_cost FROM consolidated_billing;",
+]
+
+
+class ReplayChatModel(BaseChatModel):
+    """Deterministic chat model for offline runs. SQL prompts are answered with the recorded SQL of their
+    (preprocessed) question; answer prompts echo the SQL result. latency_ms simulates the remote call."""
+
+    recordings: dict
+    latency_ms: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "replay"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = messages[-1].content
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if "Generate the corresponding SQL query" in prompt:
+            question = re.findall(r"Question: (.*)\n\s*Table Info:", prompt)[-1].strip()
+            if question not in self.recordings:
+                raise ValueError(f"No recorded SQL for question: {question}")
+            content = self.recordings[question]
+        else:
+            sql_result = re.findall(r"SQL Result: (.*)\n", prompt)
+            content = f"A: {sql_result[-1] if sql_result else ''}"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+
+def _sql_list(values):
+    return "[" + ", ".join("NULL" if v is None else "'" + v.replace("'", "''") + "'" for v in values) + "]"
+
+
+def _pick(values, bits):
+    return f"{_sql_list(values)}[1 + ((h >> {bits}) % {len(values)})::INTEGER]"
+
+
+def generate_synthetic_dataset(output_file, rows=DEFAULT_ROWS, months=DEFAULT_MONTHS, seed=DEFAULT_SEED):
+    """Writes a deterministic FOCUS-shaped Parquet file with the columns of data_processing.DESIRED_COLUMNS."""
+    service = f"{_sql_list(['|'.join(s) for s in SERVICES])}[1 + (h % {len(SERVICES)})::INTEGER]"
+    resources = max(rows // 100, 1)
+    start_time = time.perf_counter()
+    con = duckdb.connect()
+    try:
+        con.execute(f"""
+            COPY (
+                SELECT
+                    ((h >> 24) % 100000) / 1000.0 AS BilledCost,
+                    (DATE '{START_DATE}' + to_months((i % {months})::INTEGER) + to_days(((h >> 16) % 28)::INTEGER))::TIMESTAMP AS BillingPeriodStart,
+                    (DATE '{START_DATE}' + to_months((i % {months})::INTEGER) + to_days(((h >> 16) % 28)::INTEGER + 1))::TIMESTAMP AS BillingPeriodEnd,
+                    ((h >> 40) % 1000) / 10.0 AS ConsumedQuantity,
+                    {_pick(["Hours", "GB", "Requests"], 44)} AS ConsumedUnit,
+                    split_part(service, '|', 1) AS ProviderName,
+                    {_pick(REGIONS, 8)} AS RegionId,
+                    'resource-' || ((h >> 32) % {resources}) AS ResourceName,
+                    {_pick(RESOURCE_TYPES, 12)} AS ResourceType,
+                    'res-' || ((h >> 32) % {resources}) AS ResourceId,
+                    split_part(service, '|', 2) AS ServiceCategory,
+                    split_part(service, '|', 3) AS ServiceName,
+                    'account-' || ((h >> 36) % 8) AS SubAccountName,
+                    {_pick(APPLICATIONS, 48)} AS tag_application,
+                    {_pick(ENVIRONMENTS, 52)} AS tag_environment,
+                    {_pick(BUSINESS_UNITS, 56)} AS tag_business_unit
+                FROM (SELECT i, h, {service} AS service FROM (SELECT i, hash(i, {seed}) AS h FROM range({rows}) t(i)))
+            ) TO '{output_file}' (FORMAT PARQUET)
+        """)
+    finally:
+        con.close()
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    logger.info(f"Synthetic dataset with {rows} rows written to {output_file} in {elapsed_ms:.0f} ms")
+    return elapsed_ms
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of a list of numbers."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    summary = {"count": len(values), "mean": sum(values) / len(values)}
+    summary.update({f"p{pct}": percentile(values, pct) for pct in PERCENTILES})
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in summary.items()}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+
+
+def _sorted_rows(rows):
+    return sorted(rows, key=lambda row: tuple((0, float(v), "") if _is_number(v) else (1, 0.0, str(v)) for v in row))
+
+
+def rows_match(actual, expected):
+    """Compares two results as unordered row sets, allowing float summation noise (e.g. rollup vs raw scan)."""
+    if len(actual) != len(expected):
+        return False
+    for actual_row, expected_row in zip(_sorted_rows(actual), _sorted_rows(expected)):
+        if len(actual_row) != len(expected_row):
+            return False
+        for a, e in zip(actual_row, expected_row):
+            if _is_number(a) and _is_number(e):
+                if not math.isclose(float(a), float(e), rel_tol=1e-9, abs_tol=1e-6):
+                    return False
+            elif a != e:
+                return False
+    return True
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def _timed(timings, stage, func, *args, **kwargs):
+    start_time = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(stage, []).append((time.perf_counter() - start_time) * 1000)
+    return result
+
+
+def _clear_caches():
+    langchain_query.sql_cache.clear()
+    langchain_query.result_cache.clear()
+
+
+def configure_pipeline(dataset_file, cases, latency_ms=0.0):
+    """Points data_processing at the synthetic dataset and swaps the LLM for a ReplayChatModel."""
+    data_processing.DATASET_LAYOUT = "file"
+    data_processing.OUTPUT_FILE = dataset_file
+    data_processing.DUCKDB_FILE = os.path.splitext(dataset_file)[0] + ".duckdb"
+    langchain_query.performance_log.directory = os.path.splitext(dataset_file)[0] + "_performance"
+    # In memory only, so recorded SQL never leaks into the application's on-disk cache
+    langchain_query.sql_cache = TTLCache("benchmark text-to-SQL", max_entries=langchain_query.SQL_CACHE_MAX_ENTRIES)
+    start_time = time.perf_counter()
+    data_processing.get_duckdb_connection().close()
+    catalog_ms = (time.perf_counter() - start_time) * 1000
+    recordings = {langchain_query.preprocess_question(case["question"], {})[0]: case["sql"] for case in cases}
+    langchain_query.llm = ReplayChatModel(recordings=recordings, latency_ms=latency_ms)
+    return catalog_ms
+
+
+def run_benchmark(cases, iterations=DEFAULT_ITERATIONS, warm=False, table_info="Table: consolidated_billing"):
+    """Times every pipeline stage for each case and checks each result against its recorded SQL."""
+    timings = {}
+    tokens = {"prompt_1": [], "prompt_2": []}
+    case_reports = []
+    for case in cases:
+        question = case["question"]
+        with data_processing.duckdb_cursor() as con:
+            expected = con.execute(case["sql"]).fetchall()
+        for iteration in range(iterations):
+            if not warm:
+                _clear_caches()
+            context = {}
+            _timed(timings, "get_duckdb_connection", lambda: data_processing.get_duckdb_connection().close())
+            _timed(timings, "get_dataset_metadata", data_processing.get_dataset_metadata)
+            _timed(timings, "preprocess_question", langchain_query.preprocess_question, question, context)
+            sql, error, _, p1_tokens, sql_meta = _timed(timings, "generate_sql", langchain_query.generate_sql, question, table_info, context=context)
+            result, sql_ms, _, columns, summary = _timed(timings, "execute_query", langchain_query.execute_query, sql) if not error else (error, 0, False, [], None)
+            timings.setdefault("sql_execution", []).append(sql_ms)
+            answer, _, p2_tokens, _, format_meta = _timed(timings, "format_response", langchain_query.format_response, question, result, columns, context=context, summary=summary, sql_source=sql_meta.get("sql_source"))
+            if not warm:
+                _clear_caches()
+            _timed(timings, "process_question", langchain_query.process_question, question, table_info, context={})
+            tokens["prompt_1"].append(p1_tokens)
+            tokens["prompt_2"].append(p2_tokens)
+        correct = not isinstance(result, str) and result is not None and rows_match(result, expected)
+        if case.get("formatter") and format_meta.get("formatter") != case["formatter"]:
+            correct = False
+        case_reports.append({
+            "question": question, "sql": sql, "sql_source": sql_meta.get("sql_source"),
+            "formatter": format_meta.get("formatter"), "correct": correct, "answer": answer,
+        })
+        logger.info(f"{'OK  ' if correct else 'FAIL'} [{sql_meta.get('sql_source')}] {question}")
+    langchain_query.performance_log.flush()
+    correct_count = sum(1 for case in case_reports if case["correct"])
+    return {
+        "stages_ms": {stage: summarize(values) for stage, values in timings.items()},
+        "tokens": {prompt: summarize(values) for prompt, values in tokens.items()},
+        "accuracy": {
+            "cases": len(case_reports),
+            "correct": correct_count,
+            "execution_accuracy": round(correct_count / len(case_reports), 4) if case_reports else None,
+            "sql_sources": dict(Counter(case["sql_source"] for case in case_reports)),
+            "formatters": dict(Counter(case["formatter"] for case in case_reports)),
+        },
+        "cases": case_reports,
+    }
+
+
+def check_rollup_routing(queries=ROLLUP_CASES, line_items=ROLLUP_LINE_ITEMS):
+    """Runs each query on the raw line items and as routed by rollups.route_query, and reports the
+    queries routed to the rollup whose result differs from the raw scan."""
+    con = duckdb.connect()
+    try:
+        dimensions = ", ".join(f"'{column}-1' AS {column}" for column in rollups.ROLLUP_DIMENSIONS)
+        con.execute(f"""
+            CREATE TABLE consolidated_billing AS
+            SELECT {dimensions}, TIMESTAMP '{START_DATE}' AS BillingPeriodStart, cost::DOUBLE AS BilledCost
+            FROM (SELECT unnest({line_items}) AS cost)
+        """)
+        rollups.rebuild_rollups(con)
+        checks = []
+        for sql in queries:
+            routed = rollups.route_query(sql)
+            consistent = rows_match(con.execute(routed).fetchall(), con.execute(sql).fetchall())
+            checks.append({"sql": sql, "routed": routed != sql, "consistent": consistent})
+            logger.info(f"{'OK  ' if consistent else 'FAIL'} [{'rollup' if routed != sql else 'raw'}] {sql}")
+    finally:
+        con.close()
+    return {
+        "queries": len(checks),
+        "routed": sum(1 for check in checks if check["routed"]),
+        "consistent": sum(1 for check in checks if check["consistent"]),
+        "checks": checks,
+    }
+
+
+def compare_reports(baseline, current):
+    """Returns one line per stage with the p50/p95 change against a baseline report."""
+    lines = []
+    for stage, summary in current["stages_ms"].items():
+        base = baseline.get("stages_ms", {}).get(stage)
+        if not base or not base.get("count"):
+            continue
+        changes = []
+        for key in ("p50", "p95"):
+            delta = (summary[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            changes.append(f"{key} {base[key]:.2f} -> {summary[key]:.2f} ms ({delta:+.1f}%)")
+        lines.append(f"{stage:<24} " + "; ".join(changes))
+    base_accuracy = baseline.get("accuracy", {}).get("execution_accuracy")
+    lines.append(f"{'execution_accuracy':<24} {base_accuracy} -> {current['accuracy']['execution_accuracy']}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline latency and accuracy benchmark of the question pipeline.")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="rows of the synthetic dataset")
+    parser.add_argument("--months", type=int, default=DEFAULT_MONTHS, help="billing months spanned by the dataset")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="runs per question")
+    parser.add_argument("--cases", help="JSON file with a list of {\"question\", \"sql\"} recordings, each with an optional \"formatter\"")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated latency of each stub LLM call")
+    parser.add_argument("--warm", action="store_true", help="keep the SQL and result caches between runs")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="where the synthetic dataset and catalog are kept")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    cases = DEFAULT_CASES
+    if args.cases:
+        with open(args.cases, encoding="utf-8") as f:
+            cases = json.load(f)
+    os.makedirs(args.workdir, exist_ok=True)
+    dataset_file = os.path.join(args.workdir, f"synthetic_{args.rows}_{args.months}_{args.seed}.parquet")
+    generate_ms = None
+    if not os.path.exists(dataset_file):
+        generate_ms = generate_synthetic_dataset(dataset_file, args.rows, args.months, args.seed)
+    catalog_ms = configure_pipeline(dataset_file, cases, args.llm_latency_ms)
+
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "rows": args.rows,
+        "months": args.months,
+        "iterations": args.iterations,
+        "caches": "warm" if args.warm else "cold",
+        "llm_latency_ms": args.llm_latency_ms,
+        "setup_ms": {"generate_dataset": generate_ms, "first_connection": round(catalog_ms, 3)},
+    }
+    report.update(run_benchmark(cases, args.iterations, args.warm))
+    report["rollup_routing"] = check_rollup_routing()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+    print(json.dumps({k: v for k, v in report.items() if k != "cases"}, indent=2, default=str))
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare_reports(json.load(f), report)))
+
+
+if __name__ == "__main__":
+    main()
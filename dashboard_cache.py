@@ -0,0 +1,126 @@
+import argparse
+import base64
+import logging
+import os
+import threading
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+from dashboard_data import DASHBOARD_PANELS, load_dashboard_panels, load_filter_options, load_treemap_level, normalize_filters, panel_filters
+from data_processing import duckdb_cursor, get_dataset_version
+from query_cache import TTLCache, make_cache_key
+
+logger = logging.getLogger(__name__)
+
+# Dashboard panels and treemap views shared by every session and process through a SQLite store. Keys carry
+# the dataset version, so a new consolidation or ingest is never served stale numbers; a background thread
+# warms the entries of a new version as soon as it appears. Panels are keyed by the filters that apply to
+# them, so a filter change only recomputes the panels it affects.
+DASHBOARD_CACHE_FILE = os.path.join(os.path.dirname(__file__), 'cache', 'dashboard_cache.sqlite')
+DASHBOARD_CACHE_MAX_ENTRIES = 512
+DASHBOARD_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # entries of older versions are purged from disk after this
+WARM_POLL_SECONDS = 30
+DASHBOARD_CACHE_FORMAT = "arrow-ipc"  # part of every key, so entries stored in another encoding are never decoded
+dashboard_cache = TTLCache('dashboard', max_entries=DASHBOARD_CACHE_MAX_ENTRIES, ttl_seconds=DASHBOARD_CACHE_TTL_SECONDS, disk_path=DASHBOARD_CACHE_FILE)
+
+_warm_lock = threading.Lock()
+_warm_thread = None
+
+
+def _encode(frame):
+    # Frames go through the JSON store as a base64 Arrow IPC stream, which keeps every column type
+    # (decimal measures included) exactly as loaded
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+
+
+def _decode(value):
+    return pa.ipc.open_stream(base64.b64decode(value)).read_all().to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _cached(kind, version, load, *args):
+    dashboard_cache.ensure_version(version)
+    key = make_cache_key(kind, DASHBOARD_CACHE_FORMAT, version, *args)
+    value = dashboard_cache.get(key)
+    if value is None:
+        with duckdb_cursor() as con:
+            value = load(con, *args)
+        dashboard_cache.set(key, value)
+    return value
+
+
+def get_dashboard_panels(filters=None, version=None):
+    """Returns the dashboard panels (see dashboard_data.load_dashboard_panels) under a filter state, computing
+    the panels missing from the cache in a single query."""
+    version = version or get_dataset_version()
+    dashboard_cache.ensure_version(version)
+    filters = normalize_filters(filters)
+    keys = {name: make_cache_key("panel", DASHBOARD_CACHE_FORMAT, version, name, panel_filters(name, filters)) for name in DASHBOARD_PANELS}
+    values = {name: dashboard_cache.get(key) for name, key in keys.items()}
+    missing = [name for name, value in values.items() if value is None]
+    if missing:
+        with duckdb_cursor() as con:
+            loaded = load_dashboard_panels(con, filters, missing)
+        for name in missing:
+            values[name] = _encode(loaded[name])
+            dashboard_cache.set(keys[name], values[name])
+    return {name: _decode(value) for name, value in values.items()}
+
+
+def get_treemap_level(path=(), filters=None, version=None):
+    """Returns the treemap view below path (see dashboard_data.load_treemap_level) under a filter state."""
+    version = version or get_dataset_version()
+    return _decode(_cached("treemap", version, lambda con, path, filters: _encode(load_treemap_level(con, path, filters=filters)), list(path), normalize_filters(filters)))
+
+
+def get_filter_options(version=None):
+    """Returns the values offered by the dashboard filters (see dashboard_data.load_filter_options)."""
+    version = version or get_dataset_version()
+    return _cached("filter_options", version, load_filter_options)
+
+
+def warm_dashboard_cache(version=None):
+    """Computes the filter options and, without filters, the panels, the top treemap view and the drill-down
+    of every category for a dataset version."""
+    version = version or get_dataset_version()
+    get_filter_options(version)
+    panels = get_dashboard_panels(version=version)
+    get_treemap_level((), version=version)
+    for category in panels["service_category"]["ServiceCategory"].dropna():
+        get_treemap_level((category,), version=version)
+    logger.info(f"Dashboard cache warmed for dataset version {version}")
+
+
+def _warm_loop(interval):
+    warmed_version = None
+    while True:
+        try:
+            version = get_dataset_version()
+            if version != warmed_version:
+                warm_dashboard_cache(version)
+                warmed_version = version
+        except Exception as e:
+            logger.error(f"Error warming the dashboard cache: {str(e)}")
+        time.sleep(interval)
+
+
+def start_background_warm(interval=WARM_POLL_SECONDS):
+    """Starts, once per process, a daemon thread that warms the cache whenever the dataset version changes."""
+    global _warm_thread
+    with _warm_lock:
+        if _warm_thread is None:
+            _warm_thread = threading.Thread(target=_warm_loop, args=(interval,), name="dashboard-cache-warmer", daemon=True)
+            _warm_thread.start()
+    return _warm_thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warms the on-disk dashboard cache for the current dataset version.")
+    parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    warm_dashboard_cache()
@@ -0,0 +1,188 @@
+import logging
+
+import pandas as pd
+import pyarrow.compute as pc
+
+from entity_extractor import month_period
+from query_results import fetch_arrow_table
+from rollups import ROLLUP_DIMENSIONS, ROLLUP_TABLE
+
+logger = logging.getLogger(__name__)
+
+# Aggregates of every dashboard panel from a single query: each panel is a grouping set of one GROUP BY
+# GROUPING SETS pass over the monthly rollup. The result is fetched as Arrow and handed to pandas without
+# a per-row copy.
+DASHBOARD_PANELS = {
+    "total": [],
+    "provider": ["ProviderName"],
+    "service_category": ["ServiceCategory"],
+    "application": ["tag_application"],
+    "environment": ["tag_environment"],
+    "business_unit": ["tag_business_unit"],
+}
+DASHBOARD_COLUMNS = list(dict.fromkeys(column for columns in DASHBOARD_PANELS.values() for column in columns))
+# Dimensions the dashboard can be filtered on, besides a range of billing months ("months": ["YYYY-MM", "YYYY-MM"]).
+# Panels work as facets: a panel ignores the filter on its own dimension, so it keeps showing the alternatives.
+FILTER_COLUMNS = ["ProviderName", "SubAccountName", "tag_application", "tag_environment", "tag_business_unit"]
+# Treemap hierarchy. Each view shows two levels below the drilled-in path, keeping the top TREEMAP_TOP_N
+# children of every node and folding the rest into TREEMAP_OTHER_LABEL.
+TREEMAP_LEVELS = ["ServiceCategory", "ServiceName", "ResourceId"]
+TREEMAP_DEPTH = 2
+TREEMAP_TOP_N = 10
+TREEMAP_OTHER_LABEL = "Other"
+
+
+def _grouping_id(columns, grouped_columns):
+    # GROUPING() sets the bit of every column aggregated away, the first column being the most significant
+    return sum(1 << (len(grouped_columns) - 1 - i) for i, column in enumerate(grouped_columns) if column not in columns)
+
+
+def normalize_filters(filters):
+    """Canonical form of a filter state, without empty selections, so equal selections key the same cache entries."""
+    filters = filters or {}
+    normalized = {}
+    if filters.get("months"):
+        normalized["months"] = [min(filters["months"]), max(filters["months"])]
+    for column in FILTER_COLUMNS:
+        if filters.get(column):
+            normalized[column] = sorted(set(str(value) for value in filters[column]))
+    return normalized
+
+
+def filter_predicate(filters):
+    """Returns (sql, params) of the conjunction of a normalized filter state; ("TRUE", []) when it is empty."""
+    clauses, params = [], []
+    if filters.get("months"):
+        start, _ = month_period(*filters["months"][0].split("-"))
+        _, end = month_period(*filters["months"][1].split("-"))
+        # Month-aligned bounds give the same rows on the rollup as on the line items
+        clauses.append("BillingPeriodStart::TIMESTAMP >= ?::TIMESTAMP AND BillingPeriodStart::TIMESTAMP < ?::TIMESTAMP")
+        params += [start, end]
+    for column in FILTER_COLUMNS:
+        if filters.get(column):
+            clauses.append(f"{column} IN ({', '.join('?' for _ in filters[column])})")
+            params += filters[column]
+    return " AND ".join(clauses) or "TRUE", params
+
+
+def panel_filters(name, filters):
+    """Filters that apply to a panel: all of them but the one on the panel's own dimension."""
+    return {key: values for key, values in filters.items() if key not in DASHBOARD_PANELS[name]}
+
+
+def dashboard_query(filters=None, panels=None):
+    """Returns (sql, params) computing the given panels (all by default) under a filter state."""
+    filters = normalize_filters(filters)
+    panels = list(panels or DASHBOARD_PANELS)
+    columns = list(dict.fromkeys(column for name in panels for column in DASHBOARD_PANELS[name]))
+    # Filters on dimensions no requested panel groups by hold for every panel and go to WHERE; the others
+    # are applied per panel with an aggregate FILTER, keeping a single pass
+    shared = {key: values for key, values in filters.items() if key not in columns}
+    aggregates, params = [], []
+    for name in panels:
+        predicate, predicate_params = filter_predicate({key: values for key, values in panel_filters(name, filters).items() if key not in shared})
+        aggregates.append(f"SUM(BilledCost) FILTER (WHERE {predicate})" if predicate_params else "SUM(BilledCost)")
+        params += predicate_params
+    where, where_params = filter_predicate(shared)
+    if columns:
+        grouping = f"GROUPING({', '.join(columns)})"
+        ids = [_grouping_id(DASHBOARD_PANELS[name], columns) for name in panels]
+        panel = f"CASE {grouping} {' '.join(f'WHEN {i} THEN ' + repr(name) for i, name in zip(ids, panels))} END"
+        total_cost = f"CASE {grouping} {' '.join(f'WHEN {i} THEN {aggregate}' for i, aggregate in zip(ids, aggregates))} END"
+    else:
+        panel, total_cost = f"'{panels[0]}'", aggregates[0]
+    grouping_sets = ", ".join(f"({', '.join(DASHBOARD_PANELS[name])})" for name in panels)
+    sql = f"""
+        SELECT
+            {panel} AS panel,
+            {", ".join(columns + [f"NULL::VARCHAR AS {column}" for column in DASHBOARD_COLUMNS if column not in columns])},
+            {total_cost} AS total_cost
+        FROM {ROLLUP_TABLE}
+        WHERE {where}
+        GROUP BY GROUPING SETS ({grouping_sets})
+    """
+    return sql, params + where_params
+
+
+def load_dashboard_panels(con, filters=None, panels=None):
+    """Returns {panel: DataFrame of its columns and total_cost, ordered by cost} for the given panels (all by
+    default) under a filter state. Groups left without rows by their panel's filters are dropped."""
+    sql, params = dashboard_query(filters, panels)
+    con.execute(sql, params)
+    table = fetch_arrow_table(con)
+    table = table.filter(pc.is_valid(table["total_cost"]))
+    loaded = {}
+    for name in panels or DASHBOARD_PANELS:
+        rows = table.filter(pc.equal(table["panel"], name)).select(DASHBOARD_PANELS[name] + ["total_cost"])
+        loaded[name] = rows.sort_by([("total_cost", "descending")]).to_pandas(types_mapper=pd.ArrowDtype)
+    logger.info(f"Dashboard panels loaded: {', '.join(f'{name}={len(df)}' for name, df in loaded.items())}")
+    return loaded
+
+
+def load_filter_options(con):
+    """Returns {"months": [...], column: [...]} with the billing months and the values of every FILTER_COLUMNS entry."""
+    columns = ["billing_month"] + FILTER_COLUMNS
+    con.execute(f"""
+        SELECT GROUPING({", ".join(columns)}) AS grouping_id, {", ".join(columns)}
+        FROM {ROLLUP_TABLE}
+        GROUP BY GROUPING SETS ({", ".join(f"({column})" for column in columns)})
+    """)
+    table = fetch_arrow_table(con)
+    options = {}
+    for column in columns:
+        values = table.filter(pc.equal(table["grouping_id"], _grouping_id([column], columns)))[column].to_pylist()
+        options["months" if column == "billing_month" else column] = sorted(value for value in values if value is not None)
+    return options
+
+
+def _partition_by(columns):
+    return f"PARTITION BY {', '.join(columns)} " if columns else ""
+
+
+def treemap_query(path, top_n=TREEMAP_TOP_N, filters=None):
+    """Returns (sql, params) for the treemap view below path, a list of values of the first TREEMAP_LEVELS,
+    under a filter state."""
+    levels = TREEMAP_LEVELS[len(path):len(path) + TREEMAP_DEPTH]
+    predicate, predicate_params = filter_predicate(normalize_filters(filters))
+    # The rollup holds every level but ResourceId, so only drill-downs to resources scan the line items
+    table = ROLLUP_TABLE if all(level in ROLLUP_DIMENSIONS for level in levels) else "consolidated_billing"
+    conditions = [f"{column} = ?" for column in TREEMAP_LEVELS[:len(path)]] + [f"{level} IS NOT NULL" for level in levels] + [predicate]
+    # Each node's cost is summed over its subtree, then ranked among its siblings; a node keeps its label
+    # only when it and all its ancestors are within the top N
+    subtree_costs = [f"SUM(total_cost) OVER (PARTITION BY {', '.join(levels[:depth + 1])}) AS cost_{depth}" for depth in range(len(levels))]
+    ranks = [
+        f"dense_rank() OVER ({_partition_by(levels[:depth])}ORDER BY cost_{depth} DESC, {levels[depth]}) AS rank_{depth}"
+        for depth in range(len(levels))
+    ]
+    labels = [
+        f"CASE WHEN {' AND '.join(f'rank_{d} <= {int(top_n)}' for d in range(depth + 1))} THEN {level}::VARCHAR "
+        f"ELSE '{TREEMAP_OTHER_LABEL}' END AS {level}"
+        for depth, level in enumerate(levels)
+    ]
+    sql = f"""
+        WITH leaves AS (
+            SELECT {", ".join(levels)}, SUM(BilledCost) AS total_cost
+            FROM {table}
+            WHERE {" AND ".join(conditions)}
+            GROUP BY ALL
+            HAVING SUM(BilledCost) > 0
+        ),
+        subtrees AS (
+            SELECT *, {", ".join(subtree_costs)} FROM leaves
+        ),
+        ranked AS (
+            SELECT *, {", ".join(ranks)} FROM subtrees
+        )
+        SELECT {", ".join(labels)}, SUM(total_cost) AS total_cost
+        FROM ranked
+        GROUP BY ALL
+        ORDER BY total_cost DESC
+    """
+    return sql, list(path) + predicate_params
+
+
+def load_treemap_level(con, path=(), top_n=TREEMAP_TOP_N, filters=None):
+    """Returns the treemap view below path as a DataFrame of its level columns and total_cost."""
+    sql, params = treemap_query(list(path), top_n, filters)
+    con.execute(sql, params)
+    return fetch_arrow_table(con).to_pandas(types_mapper=pd.ArrowDtype)
@@ -1,8 +1,23 @@
 import duckdb
 import polars as pl
 import os
+import argparse
+import glob
+import hashlib
+import json
 import logging
+import multiprocessing
+import queue
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from urllib.parse import quote
 from sqlalchemy import create_engine
+from rollups import ROLLUP_TABLE, rebuild_rollups, refresh_rollup_partitions
+from tracing import span
 
 # Conf logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,6 +32,28 @@ DESIRED_COLUMNS = [
     "ServiceCategory", "ServiceName", "SubAccountName",
     "tag_application", "tag_environment", "tag_business_unit"  
 ]
+DATASET_LAYOUT = "file" # "file": OUTPUT_FILE monolítico; "partitioned": PARTITIONED_OUTPUT_DIRECTORY mantido pela ingestão incremental
+PARTITIONED_OUTPUT_DIRECTORY = os.path.splitext(OUTPUT_FILE)[0] + "_partitioned" # saída particionada (hive) por ProviderName/billing_month
+MANIFEST_FILE = os.path.join(PARTITIONED_OUTPUT_DIRECTORY, "_manifest.json") # manifesto dos arquivos de origem já ingeridos
+HIVE_NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+DUCKDB_FILE = os.path.splitext(OUTPUT_FILE)[0] + ".duckdb" # base dos catálogos DuckDB persistentes: um arquivo <base>-<hash>.duckdb por versão do dataset
+STREAMING_CONSOLIDATION = True # True: plano lazy com sink_parquet (memória limitada); False: coleta tudo em memória antes de gravar
+INGEST_WORKERS = os.cpu_count() or 1 # número de workers da ingestão paralela
+INGEST_EXECUTOR = "process" # "process" (ProcessPoolExecutor) ou "thread" (ThreadPoolExecutor)
+CURSOR_POOL_SIZE = 16 # número máximo de cursores ociosos mantidos no pool
+CATALOG_FORMAT = 3 # incrementar quando o conteúdo do catálogo mudar, forçando sua reconstrução
+
+# Estado do pool de conexões compartilhado pelo processo
+_pool_lock = threading.Lock()
+_shared_connection = None
+_shared_version = None
+_shared_catalog_file = None
+_lent_cursors = {} # id da conexão -> cursores emprestados por duckdb_cursor
+_retired_connections = {} # id -> (conexão, arquivo) de versões substituídas, fechadas quando seus cursores voltam
+_cursor_pool = queue.LifoQueue(maxsize=CURSOR_POOL_SIZE)
+_metadata_lock = threading.Lock()
+_metadata_cache = {"version": None, "metadata": None}
+METADATA_DIMENSIONS = ["ProviderName", "ServiceName", "ServiceCategory", "RegionId", "tag_application", "tag_environment", "tag_business_unit"]
 
 def validate_directories():
     if not os.path.exists(INPUT_DIRECTORY):
@@ -39,16 +76,86 @@ def validate_directories():
         return False
     return True
 
-def consolidate_parquet_files():
-    if not validate_directories():
-        return False
-    dataframes = []
+def find_parquet_files():
     parquet_files = []
-    
     for root, _, files in os.walk(INPUT_DIRECTORY):
         for file in files:
             if file.endswith(".parquet"):
                 parquet_files.append(os.path.join(root, file))
+    # Ordem determinística, independente da ordem de listagem do sistema de arquivos
+    return sorted(parquet_files)
+
+def _scan_source_file(file_path):
+    # Lê apenas o rodapé do Parquet para planejar a projeção; colunas ausentes entram como NULL no plano lazy
+    schema = pl.read_parquet_schema(file_path)
+    available_columns = [col for col in DESIRED_COLUMNS if col in schema]
+    if not available_columns:
+        return None, available_columns
+    lazy_df = pl.scan_parquet(file_path).select([
+        pl.col(col) if col in available_columns else pl.lit(None).alias(col)
+        for col in DESIRED_COLUMNS
+    ])
+    return lazy_df, available_columns
+
+def _ingest_source_file(file_path, part_file):
+    # Executado nos workers: grava a projeção de um arquivo de origem em um arquivo parcial
+    start_time = time.time()
+    result = {"file": file_path, "part_file": None, "rows": 0, "columns": [], "elapsed_ms": 0.0, "error": None}
+    try:
+        lazy_df, available_columns = _scan_source_file(file_path)
+        result["columns"] = available_columns
+        if lazy_df is not None:
+            lazy_df.sink_parquet(part_file)
+            result["part_file"] = part_file
+            result["rows"] = pl.scan_parquet(part_file).select(pl.len()).collect().item()
+    except Exception as e:
+        result["error"] = str(e)
+    result["elapsed_ms"] = (time.time() - start_time) * 1000
+    return result
+
+def _create_executor(max_workers):
+    if INGEST_EXECUTOR == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers)
+    # "spawn" evita herdar o pool de threads do Polars via fork
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+def ingest_source_files(parquet_files, staging_dir, max_workers=None):
+    """Processa os arquivos de origem em paralelo e retorna os resultados na mesma ordem de parquet_files."""
+    max_workers = max(1, min(max_workers or INGEST_WORKERS, len(parquet_files)))
+    logger.info(f"Ingestão paralela de {len(parquet_files)} arquivos com {max_workers} workers ({INGEST_EXECUTOR}).")
+    results = [None] * len(parquet_files)
+    with _create_executor(max_workers) as executor:
+        futures = {
+            executor.submit(_ingest_source_file, file_path, os.path.join(staging_dir, f"part-{index:06d}.parquet")): index
+            for index, file_path in enumerate(parquet_files)
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            if result["error"]:
+                logger.error(f"Erro ao processar {result['file']} ({result['elapsed_ms']:.0f} ms): {result['error']}")
+            elif result["part_file"] is None:
+                logger.warning(f"Nenhuma coluna desejada encontrada em {result['file']}. Pulando.")
+            else:
+                logger.info(f"Processado {result['file']}: {result['rows']} linhas em {result['elapsed_ms']:.0f} ms. Colunas disponíveis: {result['columns']}")
+    return results
+
+def _log_ingest_summary(results, elapsed_ms):
+    failed = [r for r in results if r["error"]]
+    skipped = [r for r in results if not r["error"] and r["part_file"] is None]
+    processed = [r for r in results if r["part_file"] is not None]
+    logger.info(f"Ingestão concluída em {elapsed_ms:.0f} ms: {len(processed)} processados, {len(skipped)} ignorados, {len(failed)} com falha.")
+    if processed:
+        slowest = max(processed, key=lambda r: r["elapsed_ms"])
+        total_file_ms = sum(r["elapsed_ms"] for r in processed)
+        logger.info(f"Tempo somado por arquivo: {total_file_ms:.0f} ms (paralelismo efetivo {total_file_ms / max(elapsed_ms, 1):.1f}x). Mais lento: {slowest['file']} ({slowest['elapsed_ms']:.0f} ms)")
+    for r in failed:
+        logger.error(f"Falha: {r['file']}: {r['error']}")
+
+def consolidate_parquet_files():
+    if not validate_directories():
+        return False
+    parquet_files = find_parquet_files()
     
     if not parquet_files:
         logger.error(f"Nenhum arquivo Parquet encontrado em: {INPUT_DIRECTORY}")
@@ -56,63 +163,462 @@ def consolidate_parquet_files():
     
     logger.info(f"Encontrados {len(parquet_files)} arquivos Parquet.")
     
-    for file_path in parquet_files:
-        logger.info(f"Processando arquivo: {file_path}")
-        try:
-            df = pl.read_parquet(file_path)
-            available_columns = [col for col in DESIRED_COLUMNS if col in df.columns]
-            if not available_columns:
-                logger.warning(f"Nenhuma coluna desejada encontrada em {file_path}. Pulando.")
-                continue
-            logger.info(f"Colunas disponíveis em {file_path}: {available_columns}")
-            df_filtered = df.select(available_columns)
-            # Adicionar colunas ausentes com NULL
-            for col in DESIRED_COLUMNS:
-                if col not in df_filtered.columns:
-                    df_filtered = df_filtered.with_columns(pl.lit(None).alias(col))
-            df_filtered = df_filtered.select(DESIRED_COLUMNS)
-            dataframes.append(df_filtered)
-        except Exception as e:
-            logger.error(f"Erro ao processar {file_path}: {str(e)}")
-            continue
-    
-    if not dataframes:
-        logger.error("Nenhum arquivo Parquet válido processado.")
-        return False
-    
-    logger.info("Concatenando arquivos...")
+    staging_dir = f"{OUTPUT_FILE}.staging"
+    temp_file = f"{OUTPUT_FILE}.tmp"
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
     try:
-        consolidated_df = pl.concat(dataframes, how="vertical")
-        logger.info(f"Arquivo consolidado contém {len(consolidated_df)} linhas.")
-        logger.info(f"Esquema final: {consolidated_df.schema}")
-        consolidated_df.write_parquet(OUTPUT_FILE)
+        start_time = time.time()
+        results = ingest_source_files(parquet_files, staging_dir)
+        _log_ingest_summary(results, (time.time() - start_time) * 1000)
+        part_files = [r["part_file"] for r in results if r["part_file"] is not None]
+        if not part_files:
+            logger.error("Nenhum arquivo Parquet válido processado.")
+            return False
+        
+        logger.info("Concatenando arquivos...")
+        # Partes concatenadas na ordem dos arquivos de origem; grava em arquivo temporário e substitui
+        # atomicamente, para que leitores nunca vejam um arquivo parcial
+        consolidated_lf = pl.concat([pl.scan_parquet(part) for part in part_files], how="vertical_relaxed")
+        if STREAMING_CONSOLIDATION:
+            consolidated_lf.sink_parquet(temp_file)
+        else:
+            consolidated_lf.collect().write_parquet(temp_file)
+        os.replace(temp_file, OUTPUT_FILE)
+        row_count = pl.scan_parquet(OUTPUT_FILE).select(pl.len()).collect().item()
+        logger.info(f"Arquivo consolidado contém {row_count} linhas.")
+        logger.info(f"Esquema final: {pl.read_parquet_schema(OUTPUT_FILE)}")
         logger.info(f"Arquivo consolidado salvo em: {OUTPUT_FILE}")
         return True
     except Exception as e:
         logger.error(f"Erro ao concatenar ou salvar o arquivo consolidado: {str(e)}")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
         return False
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
-def get_duckdb_connection():
-    if not os.path.exists(OUTPUT_FILE):
+def _file_content_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return {"files": {}, "partitions": {}}
+    with open(MANIFEST_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _save_manifest(manifest):
+    temp_file = f"{MANIFEST_FILE}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_file, MANIFEST_FILE)
+
+def _partition_key(provider, month):
+    return f"{provider}/{month}"
+
+def _partition_path(provider, month):
+    return os.path.join(
+        PARTITIONED_OUTPUT_DIRECTORY,
+        f"ProviderName={quote(provider, safe=' ')}",
+        f"billing_month={month}",
+        "data.parquet"
+    )
+
+def _with_partition_columns(lazy_df):
+    return lazy_df.with_columns(
+        pl.col("ProviderName").cast(pl.String).fill_null(HIVE_NULL_PARTITION).alias("_provider"),
+        pl.col("BillingPeriodStart").cast(pl.Datetime).dt.strftime("%Y-%m").fill_null(HIVE_NULL_PARTITION).alias("_month")
+    )
+
+def _discover_file_partitions(file_path):
+    # Lê apenas ProviderName e BillingPeriodStart para descobrir quais partições o arquivo alimenta
+    lazy_df, _ = _scan_source_file(file_path)
+    if lazy_df is None:
+        return []
+    partitions = _with_partition_columns(lazy_df).select("_provider", "_month").unique().collect()
+    return sorted(_partition_key(provider, month) for provider, month in partitions.iter_rows())
+
+def _write_partition(partition_file, provider, month, source_files):
+    # Executado nos workers: reescreve uma partição a partir de todos os arquivos de origem que a alimentam
+    start_time = time.time()
+    os.makedirs(os.path.dirname(partition_file), exist_ok=True)
+    temp_file = f"{partition_file}.{uuid.uuid4().hex}.tmp"
+    lazy_frames = []
+    for file_path in source_files:
+        lazy_df, _ = _scan_source_file(file_path)
+        if lazy_df is not None:
+            lazy_frames.append(
+                _with_partition_columns(lazy_df)
+                .filter((pl.col("_provider") == provider) & (pl.col("_month") == month))
+                .drop("_provider", "_month", "ProviderName")
+            )
+    try:
+        pl.concat(lazy_frames, how="vertical_relaxed").sink_parquet(temp_file)
+        # Substituição atômica: leitores veem a partição antiga ou a nova, nunca uma parcial
+        os.replace(temp_file, partition_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return (time.time() - start_time) * 1000
+
+def _remove_partition(provider, month):
+    partition_file = _partition_path(provider, month)
+    if os.path.exists(partition_file):
+        os.remove(partition_file)
+    shutil.rmtree(os.path.dirname(partition_file), ignore_errors=True)
+
+def incremental_ingest(max_workers=None):
+    """Ingere apenas arquivos novos ou alterados, reescrevendo somente as partições ProviderName/mês afetadas."""
+    if not os.path.exists(INPUT_DIRECTORY):
+        logger.error(f"Diretório de entrada não existe: {INPUT_DIRECTORY}")
+        return False
+    os.makedirs(PARTITIONED_OUTPUT_DIRECTORY, exist_ok=True)
+    manifest = load_manifest()
+    previous_files = manifest["files"]
+    current_files = {}
+    changed_files = []
+    
+    for file_path in find_parquet_files():
+        rel_path = os.path.relpath(file_path, INPUT_DIRECTORY)
+        stat = os.stat(file_path)
+        entry = previous_files.get(rel_path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            current_files[rel_path] = entry
+            continue
+        content_hash = _file_content_hash(file_path)
+        if entry and entry["hash"] == content_hash:
+            current_files[rel_path] = dict(entry, mtime=stat.st_mtime_ns)
+            continue
+        current_files[rel_path] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": content_hash, "partitions": []}
+        changed_files.append(rel_path)
+    removed_files = sorted(set(previous_files) - set(current_files))
+    
+    if not changed_files and not removed_files:
+        logger.info("Nenhum arquivo novo ou alterado. Dataset particionado já está atualizado.")
+        if current_files != previous_files:
+            _save_manifest(dict(manifest, files=current_files))
+        return True
+    logger.info(f"Ingestão incremental: {len(changed_files)} arquivos novos/alterados, {len(removed_files)} removidos.")
+    
+    affected = set()
+    for rel_path in removed_files:
+        affected.update(previous_files[rel_path]["partitions"])
+    for rel_path in changed_files:
+        try:
+            current_files[rel_path]["partitions"] = _discover_file_partitions(os.path.join(INPUT_DIRECTORY, rel_path))
+        except Exception as e:
+            logger.error(f"Erro ao processar {rel_path}: {str(e)}")
+            # Mantém a entrada anterior para que o arquivo seja tentado novamente na próxima execução
+            if rel_path in previous_files:
+                current_files[rel_path] = previous_files[rel_path]
+            else:
+                del current_files[rel_path]
+            continue
+        affected.update(current_files[rel_path]["partitions"])
+        if rel_path in previous_files:
+            affected.update(previous_files[rel_path]["partitions"])
+    
+    partitions = dict(manifest["partitions"])
+    to_write = {}
+    for key in sorted(affected):
+        sources = sorted(rel_path for rel_path, entry in current_files.items() if key in entry["partitions"])
+        if sources:
+            to_write[key] = sources
+        else:
+            provider, month = key.rsplit("/", 1)
+            logger.info(f"Removendo partição sem dados de origem: {key}")
+            _remove_partition(provider, month)
+            partitions.pop(key, None)
+    
+    if to_write:
+        max_workers = max(1, min(max_workers or INGEST_WORKERS, len(to_write)))
+        logger.info(f"Reescrevendo {len(to_write)} partições com {max_workers} workers ({INGEST_EXECUTOR}).")
+        with _create_executor(max_workers) as executor:
+            futures = {}
+            for key, sources in to_write.items():
+                provider, month = key.rsplit("/", 1)
+                source_paths = [os.path.join(INPUT_DIRECTORY, rel_path) for rel_path in sources]
+                futures[executor.submit(_write_partition, _partition_path(provider, month), provider, month, source_paths)] = key
+            failed_files = set()
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    elapsed_ms = future.result()
+                except Exception as e:
+                    logger.error(f"Erro ao gravar partição {key}: {str(e)}")
+                    failed_files.update(rel_path for rel_path in to_write[key] if rel_path in changed_files)
+                    continue
+                fingerprint = hashlib.sha256("".join(current_files[rel_path]["hash"] for rel_path in to_write[key]).encode()).hexdigest()
+                partitions[key] = {"sources": to_write[key], "fingerprint": fingerprint}
+                logger.info(f"Partição {key} gravada em {elapsed_ms:.0f} ms a partir de {len(to_write[key])} arquivos.")
+        # Arquivos de partições com falha voltam ao estado anterior no manifesto e serão reprocessados
+        for rel_path in failed_files:
+            if rel_path in previous_files:
+                current_files[rel_path] = previous_files[rel_path]
+            else:
+                del current_files[rel_path]
+    
+    _save_manifest({"files": current_files, "partitions": partitions})
+    logger.info(f"Manifesto atualizado: {MANIFEST_FILE}")
+    return True
+
+def _dataset_path():
+    return MANIFEST_FILE if DATASET_LAYOUT == "partitioned" else OUTPUT_FILE
+
+def _dataset_source_sql():
+    if DATASET_LAYOUT == "partitioned":
+        glob_path = os.path.join(PARTITIONED_OUTPUT_DIRECTORY, "*", "*", "*.parquet")
+        return f"read_parquet('{glob_path}', hive_partitioning = true, hive_types = {{'billing_month': VARCHAR}}, union_by_name = true)"
+    return f"'{OUTPUT_FILE}'"
+
+def _ensure_dataset():
+    if os.path.exists(_dataset_path()):
+        return
+    if DATASET_LAYOUT == "partitioned":
+        logger.error(f"Manifesto não encontrado: {MANIFEST_FILE}. Executando ingestão incremental...")
+        if not incremental_ingest():
+            raise FileNotFoundError(f"Não foi possível criar o dataset particionado em {PARTITIONED_OUTPUT_DIRECTORY}.")
+    else:
         logger.error(f"Arquivo Parquet não encontrado: {OUTPUT_FILE}. Executando consolidação...")
         if not consolidate_parquet_files():
             raise FileNotFoundError(f"Não foi possível criar o arquivo {OUTPUT_FILE}.")
-    
-    con = duckdb.connect(database=':memory:')
+
+def get_dataset_version():
+    """Retorna a impressão digital (tamanho + mtime) da versão atual do dataset (arquivo consolidado ou manifesto)."""
+    stat = os.stat(_dataset_path())
+    return f"{DATASET_LAYOUT}-{stat.st_size}-{stat.st_mtime_ns}"
+
+def _catalog_version(version):
+    return f"{version}/catalog-{CATALOG_FORMAT}"
+
+def _table_exists(con, table_name):
+    return con.execute("SELECT 1 FROM information_schema.tables WHERE table_name = ?", [table_name]).fetchone() is not None
+
+def _partition_values(key):
+    provider, month = key.rsplit("/", 1)
+    return (None if provider == HIVE_NULL_PARTITION else provider, None if month == HIVE_NULL_PARTITION else month)
+
+def _sync_partitioned_rollups(con):
+    # Atualiza o rollup apenas nas partições cujo fingerprint mudou desde a última carga
+    current = {key: entry["fingerprint"] for key, entry in load_manifest()["partitions"].items()}
+    if not _table_exists(con, "rollup_partitions"):
+        rebuild_rollups(con)
+        con.execute("CREATE TABLE rollup_partitions (partition_key VARCHAR PRIMARY KEY, fingerprint VARCHAR)")
+    else:
+        stored = dict(con.execute("SELECT partition_key, fingerprint FROM rollup_partitions").fetchall())
+        stale = sorted(key for key in set(stored) | set(current) if stored.get(key) != current.get(key))
+        refresh_rollup_partitions(con, [_partition_values(key) for key in stale])
+        con.execute("DELETE FROM rollup_partitions")
+    if current:
+        con.executemany("INSERT INTO rollup_partitions VALUES (?, ?)", list(current.items()))
+
+def _catalog_file(version):
+    # Cada versão do catálogo tem seu próprio arquivo: um arquivo aberto por outra conexão ou processo nunca é reescrito
+    digest = hashlib.sha256(_catalog_version(version).encode("utf-8")).hexdigest()[:16]
+    return f"{os.path.splitext(DUCKDB_FILE)[0]}-{digest}.duckdb"
+
+def _catalog_files():
+    return glob.glob(f"{glob.escape(os.path.splitext(DUCKDB_FILE)[0])}-*.duckdb")
+
+def _reusable_catalog():
+    # Catálogo mais recente no mesmo CATALOG_FORMAT; o de um formato anterior tem outras tabelas e colunas
+    # (ex.: o rollup sem SubAccountName) e rollup_partitions impediria sua reconstrução
+    for path in sorted(_catalog_files(), key=os.path.getmtime, reverse=True):
+        try:
+            con = duckdb.connect(database=path, read_only=True)
+        except duckdb.Error as e:
+            logger.info(f"Catálogo {path} ignorado: {str(e)}")
+            continue
+        try:
+            row = con.execute("SELECT value FROM dataset_metadata WHERE key = 'version'").fetchone() if _table_exists(con, "dataset_metadata") else None
+        finally:
+            con.close()
+        if row and row[0].endswith(f"/catalog-{CATALOG_FORMAT}"):
+            return path
+    return None
+
+def _remove_catalog_file(path):
+    for file_path in (path, path + ".wal"):
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Ainda aberto por outro processo (Windows); será removido numa próxima troca de versão
+            logger.info(f"Catálogo antigo {file_path} mantido: {str(e)}")
+
+def build_duckdb_catalog(version):
+    """Constrói o catálogo da versão num arquivo temporário e o publica atomicamente em _catalog_file(version).
+    Retorna o caminho do catálogo; se ele já existir, nada é reconstruído."""
+    catalog_file = _catalog_file(version)
+    if os.path.exists(catalog_file):
+        return catalog_file
+    temp_file = f"{catalog_file}.{os.getpid()}.tmp"
+    _remove_catalog_file(temp_file)
+    if DATASET_LAYOUT == "partitioned":
+        # Parte do catálogo mais recente do mesmo formato, para que o rollup seja atualizado apenas nas
+        # partições alteradas; sem ele, o rollup é reconstruído por inteiro
+        previous = _reusable_catalog()
+        if previous:
+            shutil.copyfile(previous, temp_file)
+    logger.info(f"Carregando {_dataset_path()} no catálogo DuckDB {catalog_file} (versão {version})...")
+    con = duckdb.connect(database=temp_file)
     try:
-        con.execute("SHOW TABLES")
-        tables = [row[0] for row in con.fetchall()]
-        if 'consolidated_billing' not in tables:
-            logger.info(f"Carregando {OUTPUT_FILE} no DuckDB...")
-            con.execute(f"CREATE TABLE consolidated_billing AS SELECT * FROM '{OUTPUT_FILE}'")
-        return con
-    except Exception as e:
-        logger.error(f"Erro ao carregar tabela no DuckDB: {str(e)}")
+        existing = con.execute("SELECT table_type FROM information_schema.tables WHERE table_name = 'consolidated_billing'").fetchone()
+        if existing:
+            con.execute(f"DROP {'VIEW' if existing[0] == 'VIEW' else 'TABLE'} consolidated_billing")
+        if DATASET_LAYOUT == "partitioned":
+            # View sobre o dataset particionado: filtros em ProviderName/billing_month podam arquivos
+            con.execute(f"CREATE VIEW consolidated_billing AS SELECT * FROM {_dataset_source_sql()}")
+            _sync_partitioned_rollups(con)
+        else:
+            con.execute(f"CREATE TABLE consolidated_billing AS SELECT * FROM {_dataset_source_sql()}")
+            rebuild_rollups(con)
+            con.execute("DROP TABLE IF EXISTS rollup_partitions")
+        con.execute("CREATE TABLE IF NOT EXISTS dataset_metadata (key VARCHAR PRIMARY KEY, value VARCHAR)")
+        con.execute("INSERT OR REPLACE INTO dataset_metadata VALUES ('version', ?)", [_catalog_version(version)])
+    except Exception:
         con.close()
+        _remove_catalog_file(temp_file)
         raise
+    con.close()
+    try:
+        os.replace(temp_file, catalog_file)
+    except OSError:
+        # Outro processo publicou a mesma versão e a mantém aberta
+        if not os.path.exists(catalog_file):
+            raise
+        _remove_catalog_file(temp_file)
+    logger.info("Catálogo DuckDB atualizado.")
+    return catalog_file
+
+def _drain_cursor_pool():
+    while True:
+        try:
+            _cursor_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+def _retire_connection(con, catalog_file):
+    # Chamado com _pool_lock: a conexão substituída só é fechada quando seus cursores emprestados voltarem
+    if _lent_cursors.get(id(con), 0):
+        _retired_connections[id(con)] = (con, catalog_file)
+    else:
+        _lent_cursors.pop(id(con), None)
+        con.close()
+
+def _get_shared_connection():
+    global _shared_connection, _shared_version, _shared_catalog_file
+    _ensure_dataset()
+    version = get_dataset_version()
+    with _pool_lock:
+        if _shared_connection is not None and _shared_version == version:
+            return _shared_connection, version
+        with span("duckdb_catalog_open", dataset_version=version) as current:
+            catalog_file = _catalog_file(version)
+            if not os.path.exists(catalog_file):
+                if current:
+                    current.set_attribute("rebuilt", True)
+                build_duckdb_catalog(version)
+            con = duckdb.connect(database=catalog_file, read_only=True)
+            if _shared_connection is not None:
+                logger.info(f"Nova versão do dataset detectada ({version}). Trocando para o catálogo {catalog_file}...")
+                _drain_cursor_pool()
+                _retire_connection(_shared_connection, _shared_catalog_file)
+            _shared_connection, _shared_version, _shared_catalog_file = con, version, catalog_file
+            in_use = {catalog_file} | {path for _, path in _retired_connections.values()}
+            for path in _catalog_files():
+                if path not in in_use:
+                    _remove_catalog_file(path)
+            return con, version
+
+def get_duckdb_connection():
+    """Retorna um novo cursor somente leitura sobre o catálogo compartilhado. O chamador deve fechá-lo;
+    prefira duckdb_cursor, cujos cursores mantêm aberto o catálogo de uma versão substituída até voltarem."""
+    con, _ = _get_shared_connection()
+    return con.cursor()
+
+@contextmanager
+def duckdb_cursor():
+    """Empresta um cursor somente leitura do pool do processo e o devolve ao final."""
+    with span("duckdb_cursor") as current:
+        while True:
+            con, _ = _get_shared_connection()
+            with _pool_lock:
+                # A versão pode ter mudado entre as duas etapas; nesse caso busca a nova conexão
+                if con is not _shared_connection:
+                    continue
+                _lent_cursors[id(con)] = _lent_cursors.get(id(con), 0) + 1
+                try:
+                    cursor = _cursor_pool.get_nowait()
+                    pooled = True
+                except queue.Empty:
+                    cursor = con.cursor()
+                    pooled = False
+                break
+        if current:
+            current.set_attribute("pooled", pooled)
+    try:
+        yield cursor
+    finally:
+        with _pool_lock:
+            _lent_cursors[id(con)] -= 1
+            if con is _shared_connection:
+                try:
+                    _cursor_pool.put_nowait(cursor)
+                except queue.Full:
+                    cursor.close()
+            else:
+                cursor.close()
+                if id(con) in _retired_connections and not _lent_cursors[id(con)]:
+                    _retired_connections.pop(id(con))
+                    del _lent_cursors[id(con)]
+                    con.close()
+
+def get_dataset_metadata():
+    """Retorna o catálogo de metadados do dataset (período, ano mais recente por mês e valores distintos),
+    calculado uma única vez por versão do dataset e mantido em memória."""
+    _, version = _get_shared_connection()
+    with _metadata_lock:
+        if _metadata_cache["version"] == version:
+            return _metadata_cache["metadata"]
+        logger.info(f"Calculando catálogo de metadados para a versão {version}...")
+        with span("dataset_metadata_load", dataset_version=version), duckdb_cursor() as con:
+            min_date, max_date = con.execute(
+                "SELECT MIN(BillingPeriodStart)::TIMESTAMP, MAX(BillingPeriodStart)::TIMESTAMP FROM consolidated_billing"
+            ).fetchone()
+            # Demais metadados saem do rollup, que já está agregado por mês e dimensão
+            month_years = dict(con.execute(
+                f"SELECT strftime(BillingPeriodStart, '%m'), MAX(strftime(BillingPeriodStart, '%Y')) FROM {ROLLUP_TABLE} "
+                "WHERE BillingPeriodStart IS NOT NULL GROUP BY 1"
+            ).fetchall())
+            distinct_values = {
+                column: [row[0] for row in con.execute(
+                    f"SELECT DISTINCT {column} FROM {ROLLUP_TABLE} WHERE {column} IS NOT NULL ORDER BY 1"
+                ).fetchall()]
+                for column in METADATA_DIMENSIONS
+            }
+        metadata = {
+            "version": version,
+            "min_date": min_date,
+            "max_date": max_date,
+            "month_years": month_years,
+            "distinct_values": distinct_values
+        }
+        _metadata_cache.update(version=version, metadata=metadata)
+        return metadata
 
 if __name__ == "__main__":
-    if not os.path.exists(OUTPUT_FILE):
+    parser = argparse.ArgumentParser(description="Consolidação dos arquivos de billing FOCUS")
+    parser.add_argument("--incremental", action="store_true", help="ingere apenas arquivos novos/alterados no dataset particionado")
+    args = parser.parse_args()
+    if args.incremental:
+        incremental_ingest()
+    elif not os.path.exists(OUTPUT_FILE):
         logger.info("Arquivo consolidado não existe. Iniciando consolidação...")
         consolidate_parquet_files()
     else:
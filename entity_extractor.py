@@ -0,0 +1,165 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Single-pass entity extraction for preprocess_question. Aliases, rewrites, month names and the distinct
+# values of the dataset dimensions are compiled into one trie-shaped regex with word boundaries.
+MONTHS = {
+    "january": "01", "february": "02", "march": "03", "april": "04", "may": "05", "june": "06",
+    "july": "07", "august": "08", "september": "09", "october": "10", "november": "11", "december": "12"
+}
+# Jargon resolved to a filter
+ALIASES = {
+    "ec2": ("ServiceName", "Amazon Elastic Compute Cloud"),
+    "s3": ("ServiceName", "Amazon Simple Storage Service"),
+    "rds": ("ServiceName", "Amazon Relational Database Service"),
+    "vm": ("ServiceName", "Microsoft Azure Virtual Machines"),
+    "compute": ("ServiceCategory", "Compute"),
+    "storage": ("ServiceCategory", "Storage"),
+    "networking": ("ServiceCategory", "Networking"),
+    "database": ("ServiceCategory", "Database"),
+    "aws": ("ProviderName", "AWS"),
+    "azure": ("ProviderName", "Microsoft"),
+    "gcp": ("ProviderName", "Google Cloud"),
+}
+# Words rewritten for the LLM without becoming a filter
+REWRITES = {"consumption": "cost", "top": "top consumers"}
+# Dataset columns whose distinct values are matched verbatim (case-insensitive) in questions
+EXTRACTED_COLUMNS = ["ServiceName", "ProviderName", "ServiceCategory", "RegionId", "tag_application", "tag_environment", "tag_business_unit"]
+# Words naming a column in a question; a weak value only becomes a filter right after one of its column's words
+COLUMN_WORDS = {
+    "ServiceName": ["service"],
+    "ProviderName": ["provider"],
+    "ServiceCategory": ["category"],
+    "RegionId": ["region"],
+    "tag_application": ["application", "app"],
+    "tag_environment": ["environment", "env"],
+    "tag_business_unit": ["business unit", "bu"],
+}
+# Values too generic to be read as a filter on their own: they are weak, matched only when qualified by
+# a column word ("application it") or quoted ('it'), as are values shorter than MIN_VALUE_LENGTH
+IGNORED_VALUES = {"global", "other", "others", "none", "null", "unknown", "default", "n/a", "na", "all", "total", "cost"}
+ENGLISH_STOPWORDS = {
+    "a", "about", "all", "an", "and", "any", "are", "as", "at", "be", "by", "can", "did", "do", "does", "each", "for",
+    "from", "had", "has", "have", "he", "her", "his", "how", "i", "if", "in", "into", "is", "it", "its", "last", "me",
+    "more", "most", "my", "new", "next", "no", "not", "now", "of", "off", "on", "one", "only", "or", "our", "out", "over",
+    "per", "she", "so", "some", "than", "that", "the", "their", "them", "then", "there", "these", "they", "this", "to",
+    "top", "up", "us", "was", "we", "were", "what", "when", "where", "which", "who", "why", "will", "with", "you", "your",
+}
+MIN_VALUE_LENGTH = 3
+
+
+def month_period(year, month_num):
+    next_month = str(int(month_num) + 1).zfill(2) if int(month_num) < 12 else "01"
+    next_year = year if int(month_num) < 12 else str(int(year) + 1)
+    return f"{year}-{month_num}-01", f"{next_year}-{next_month}-01"
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _trie_pattern(phrases):
+    # Factoring common prefixes keeps matching cost flat as the dictionary grows to thousands of values;
+    # the greedy optional groups make the longest phrase win at each position
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return build(trie)
+
+
+class EntityExtractor:
+    """Compiled matcher that rewrites a question and extracts its filters and period in one pass.
+
+    distinct_values maps a column to the values found in the dataset; month_years maps a month number
+    ("01") to the most recent year it appears in, used for months mentioned without a year. A phrase shared
+    by values of several columns is not turned into a filter but reported in entities["ambiguous"].
+    """
+
+    def __init__(self, distinct_values=None, month_years=None):
+        self.month_years = month_years or {}
+        self.phrases = {alias: ("filter", [(column, value)]) for alias, (column, value) in ALIASES.items()}
+        self.phrases.update({word: ("rewrite", text) for word, text in REWRITES.items()})
+        self.weak_phrases = {}
+        for column in EXTRACTED_COLUMNS:
+            for value in (distinct_values or {}).get(column, []):
+                phrase = str(value).strip().lower()
+                if not phrase or self.phrases.get(phrase, ("filter",))[0] == "rewrite":
+                    continue
+                weak = len(phrase) < MIN_VALUE_LENGTH or phrase in IGNORED_VALUES or phrase in ENGLISH_STOPWORDS or phrase in MONTHS
+                entries = (self.weak_phrases if weak else self.phrases).setdefault(phrase, ("filter", []))[1]
+                if (column, str(value)) not in entries:
+                    entries.append((column, str(value)))
+        self.qualifiers = {word: column for column, words in COLUMN_WORDS.items() for word in words}
+        weak_pattern = _trie_pattern(self.weak_phrases) if self.weak_phrases else "(?!)"
+        self.pattern = re.compile(
+            rf"(?<!\w)(?:(?P<qualifier>{_trie_pattern(self.qualifiers)})\s+(?P<weak>{weak_pattern})"
+            rf"|(?P<quote>['\"])(?P<quoted>{weak_pattern})(?P=quote)"
+            rf"|(?P<phrase>{_trie_pattern(self.phrases)})"
+            rf"|(?P<month>{_trie_pattern(MONTHS)})(?:\s+(?P<year>\d{{4}}))?)(?!\w)"
+        )
+
+    def extract(self, question):
+        """Returns (rewritten question, entities) for a question; entities holds filters, period, month_count,
+        terms and ambiguous, the phrases matching values of several columns."""
+        question = question.lower()
+        entities = {'filters': {}, 'period': None, 'month_count': 0, 'terms': [], 'ambiguous': []}
+        has_explicit_year = re.search(r'\d{4}', question) is not None
+        months_seen = set()
+
+        def add_filter(term, entries):
+            if term not in entities['terms']:
+                entities['terms'].append(term)
+            columns = list(dict.fromkeys(column for column, _ in entries))
+            if len(columns) > 1:
+                # Left for the LLM to resolve rather than guessing one of the columns
+                entities['ambiguous'].append({'phrase': term, 'columns': columns})
+                return f"{_quote(entries[0][1])} ({' or '.join(columns)})"
+            values = entities['filters'].setdefault(columns[0], [])
+            values.extend(value for _, value in entries if value not in values)
+            if len(entries) == 1:
+                return f"{columns[0]} = {_quote(entries[0][1])}"
+            return f"{columns[0]} IN ({', '.join(_quote(value) for _, value in entries)})"
+
+        def replace(match):
+            if match.group('weak'):
+                column = self.qualifiers[match.group('qualifier')]
+                entries = [entry for entry in self.weak_phrases[match.group('weak')][1] if entry[0] == column]
+                return add_filter(match.group(0), entries) if entries else match.group(0)
+            if match.group('quoted'):
+                return add_filter(match.group('quoted'), self.weak_phrases[match.group('quoted')][1])
+            phrase = match.group('phrase')
+            if phrase:
+                entry = self.phrases[phrase]
+                if entry[0] == "rewrite":
+                    return entry[1]
+                return add_filter(phrase, entry[1])
+            month_name, year = match.group('month'), match.group('year')
+            month_num = MONTHS[month_name]
+            if month_name not in months_seen:
+                months_seen.add(month_name)
+                entities['month_count'] += 1
+            if year:
+                entities['period'] = month_period(year, month_num)
+                entities['terms'].append(match.group(0))
+                return match.group(0)
+            last_year = self.month_years.get(month_num)
+            if has_explicit_year or not last_year:
+                return match.group(0)
+            entities['period'] = month_period(last_year, month_num)
+            entities['terms'].append(month_name)
+            return f"BillingPeriodStart >= '{entities['period'][0]}' AND BillingPeriodStart < '{entities['period'][1]}'"
+
+        return self.pattern.sub(replace, question), entities
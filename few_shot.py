@@ -0,0 +1,146 @@
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import defaultdict
+
+import duckdb
+
+from perf_log import create_performance_views
+
+logger = logging.getLogger(__name__)
+
+# Library of question -> SQL examples for the Text-to-SQL prompt. A BM25 index over the example
+# questions picks the few most similar ones per request, so the prompt stays the same size however
+# many examples the library holds.
+SEED_EXAMPLES = [
+    {"question": "How much did we spend on S3 in us-east-1?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName = 'Amazon Simple Storage Service' AND RegionId = 'us-east-1' GROUP BY ServiceName LIMIT 5;"},
+    {"question": "What was the cost of EC2 and EKS?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName IN ('Amazon Elastic Compute Cloud', 'Amazon Elastic Kubernetes Services') GROUP BY ServiceName LIMIT 5;"},
+    {"question": "Which services spent the most in the United States last month?",
+     "sql": "SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE RegionId IN ('us-east-1', 'us-west-1', 'us-west-2') AND BillingPeriodStart >= '2024-09-01' AND BillingPeriodStart < '2024-10-01' GROUP BY ServiceName ORDER BY total_cost DESC LIMIT 5;"},
+    {"question": "What was the consumption in January 2024?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2024-01-01' AND BillingPeriodStart < '2024-02-01';"},
+    {"question": "What is the month-over-month consumption comparison?",
+     "sql": "SELECT date_trunc('month', BillingPeriodStart) AS month, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY date_trunc('month', BillingPeriodStart) ORDER BY month;"},
+    {"question": "What is the total cloud consumption?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing;"},
+    {"question": "Which applications consumed the most compute services?",
+     "sql": "SELECT tag_application, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceCategory = 'Compute' GROUP BY tag_application ORDER BY total_cost DESC LIMIT 5;"},
+    {"question": "Cost by application and environment",
+     "sql": "SELECT tag_application, tag_environment, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY tag_application, tag_environment ORDER BY total_cost DESC LIMIT 5;"},
+    {"question": "Cost of compute in the AWS provider?",
+     "sql": "SELECT ServiceCategory, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceCategory = 'Compute' AND ProviderName = 'AWS' GROUP BY ServiceCategory LIMIT 5;"},
+    {"question": "What is the total consumption of Azure?",
+     "sql": "SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ProviderName = 'Microsoft';"},
+]
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class ExampleLibrary:
+    """Thread-safe question -> SQL example store with an in-memory BM25 index over the questions.
+
+    Adding a question that is already present (same tokens) replaces its SQL.
+    """
+
+    def __init__(self, examples=(), k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._examples = []
+        self._lengths = []
+        self._positions = {}
+        self._postings = defaultdict(dict)
+        self._total_length = 0
+        self._lock = threading.Lock()
+        self.add_many(examples)
+
+    def __len__(self):
+        return len(self._examples)
+
+    def add(self, question, sql):
+        tokens = tokenize(question)
+        key = " ".join(tokens)
+        with self._lock:
+            if key in self._positions:
+                self._examples[self._positions[key]] = (question, sql)
+                return
+            doc = len(self._examples)
+            self._positions[key] = doc
+            self._examples.append((question, sql))
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+            for token in tokens:
+                self._postings[token][doc] = self._postings[token].get(doc, 0) + 1
+
+    def add_many(self, examples):
+        for example in examples:
+            self.add(example["question"], example["sql"])
+
+    def search(self, question, k):
+        """Returns up to k (question, sql) pairs ranked by BM25 similarity to the question.
+        When nothing matches, the first k examples (the seeds) are returned instead."""
+        with self._lock:
+            count = len(self._examples)
+            if not count or k <= 0:
+                return []
+            average_length = self._total_length / count or 1
+            scores = defaultdict(float)
+            for token in set(tokenize(question)):
+                postings = self._postings.get(token)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[doc] / average_length)
+                    scores[doc] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+            if not scores:
+                return self._examples[:k]
+            best = heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
+            return [self._examples[doc] for doc, _ in best]
+
+
+def format_examples(examples):
+    return "\n".join(f'    - Question: "{question}"\n      {sql}' for question, sql in examples)
+
+
+def load_examples_file(path):
+    """Reads curated examples from a JSON list of {"question", "sql"} objects."""
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error reading few-shot examples from {path}: {str(e)}")
+        return []
+
+
+def load_performance_log_examples(directory, limit=5000):
+    """Reads the latest LLM-generated SQL of each question that executed and was answered without errors."""
+    if not os.path.isdir(directory):
+        return []
+    con = duckdb.connect()
+    try:
+        create_performance_views(con, directory)
+        rows = con.execute("""
+            SELECT user_question, arg_max(llm_1_response_sql, timestamp)
+            FROM performance_log
+            WHERE status = 'ok' AND sql_source = 'llm' AND llm_1_response_sql IS NOT NULL
+            GROUP BY user_question
+            ORDER BY max(timestamp) DESC
+            LIMIT ?
+        """, [limit]).fetchall()
+        return [{"question": question, "sql": sql} for question, sql in rows]
+    except Exception as e:
+        logger.error(f"Error loading few-shot examples from the performance log: {str(e)}")
+        return []
+    finally:
+        con.close()
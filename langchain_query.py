@@ -1,16 +1,30 @@
-import streamlit as st
 #from langchain_groq import ChatGroq
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import PromptTemplate
-from data_processing import get_duckdb_connection
+from data_processing import duckdb_cursor, get_dataset_metadata, get_dataset_version
+from rollups import route_query
+from query_cache import TTLCache, canonicalize_sql, make_cache_key
+from sql_templates import compile_template_sql
+from answer_formatter import format_answer
+from query_results import fetch_bounded, result_for_prompt, result_to_csv
+from sql_guard import QueryTimeout, check_query, query_timeout
+from entity_extractor import EntityExtractor, month_period
+from few_shot import SEED_EXAMPLES, ExampleLibrary, format_examples, load_examples_file, load_performance_log_examples
+from perf_log import PerformanceLogWriter
+from prompt_compiler import CompiledPrompt, usage_details
+from tracing import JsonLinesExporter, Tracer, current_span, span, traced
 import logging
 import re
 import os
 from dotenv import load_dotenv, find_dotenv
 import time
 import math
-import csv
 import uuid
+import asyncio
+import threading
+import functools
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 # Try to import tiktoken for accurate token counting
 try:
@@ -41,45 +55,72 @@ if not getattr(logger, 'has_run_before', False):
     logger.info(f"Standard logs will be saved to {log_file}")
     logger.has_run_before = True
 
-# --- PERFORMANCE CSV LOGGING SETUP ---
-PERFORMANCE_LOG_FILE = os.path.join(log_dir, 'llm_performance_log.csv')
-CSV_HEADER = [
-    'request_id',
-    'user_question',
-    'prompt_1_text',
-    'prompt_1_tokens',
-    'llm_1_response_sql',
-    'sql_execution_time_ms',
-    'prompt_2_text',
-    'prompt_2_tokens',
-    'llm_2_response_time_ms',
-    'llm_2_final_response'
-]
-
-def log_performance_to_csv(data):
-    """Appends a new row to the performance CSV log file."""
-    file_exists = os.path.isfile(PERFORMANCE_LOG_FILE)
+# --- PERFORMANCE LOGGING SETUP ---
+# Records are batched by a background thread into daily Parquet files; see perf_log.py for the summary views
+PERFORMANCE_LOG_DIR = os.path.join(log_dir, 'performance')
+performance_log = PerformanceLogWriter(PERFORMANCE_LOG_DIR)
+
+# --- TEXT-TO-SQL CACHE SETUP ---
+cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
+SQL_CACHE_MAX_ENTRIES = 1000
+SQL_CACHE_TTL_SECONDS = 24 * 60 * 60
+SQL_CACHE_FILE = os.path.join(cache_dir, 'sql_cache.sqlite')  # set to None to keep the cache in memory only
+sql_cache = TTLCache('text-to-SQL', max_entries=SQL_CACHE_MAX_ENTRIES, ttl_seconds=SQL_CACHE_TTL_SECONDS, disk_path=SQL_CACHE_FILE)
+
+# --- TEMPLATE SQL FAST PATH SETUP ---
+TEMPLATE_SQL_ENABLED = True
+TEMPLATE_SQL_MIN_CONFIDENCE = 0.85  # below this the question is sent to the LLM
+
+# --- LOCAL ANSWER FORMATTER SETUP ---
+LOCAL_FORMATTER_ENABLED = True
+
+# --- QUERY RESULT CACHE SETUP ---
+RESULT_CACHE_MAX_ENTRIES = 500
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+result_cache = TTLCache('query result', max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES)
+
+# --- QUERY RESULT LIMITS ---
+# Results are fetched as Arrow batches and capped; larger results keep only a summary of every row
+RESULT_MAX_ROWS = 10000
+RESULT_MAX_BYTES = 8 * 1024 * 1024
+RESULT_SUMMARY_TOP_N = 10
+PROMPT_MAX_ROWS = 50  # above this the response prompt gets the summary instead of the rows
+
+# --- SQL GUARD SETUP ---
+# LLM-generated SQL is parsed and planned before it runs (sql_guard.py); every query runs under a timeout
+SQL_GUARD_ALLOWED_TABLES = {'consolidated_billing'}
+SQL_GUARD_MAX_PLAN_ROWS = 100 * 1000 * 1000  # estimated rows of any plan operator above this reject the query
+SQL_GUARD_LIMIT_ROWS = RESULT_MAX_ROWS  # non-aggregated queries estimated above this get a LIMIT
+QUERY_TIMEOUT_SECONDS = 30  # set to None to disable
+
+# Background worker for work kept off the request's critical path (performance log, cache writes)
+_background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="langchain-query-background")
+
+# Per-request tracing with nested spans per stage; tracing.ConsoleExporter and tracing.OtlpFileExporter
+# can be added with tracer.add_exporter
+TRACING_ENABLED = True
+TRACE_FILE = os.path.join(log_dir, 'traces.jsonl')
+TRACE_DUCKDB_PROFILE = False  # attach DuckDB's JSON profile of each executed query to its span
+tracer = Tracer([JsonLinesExporter(TRACE_FILE)], enabled=TRACING_ENABLED, executor=_background_executor)
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    # Loaded once; a failed load (e.g. no network to fetch the BPE file) is cached too, so it is not retried per call
+    if not tiktoken_available:
+        return None
     try:
-        with open(PERFORMANCE_LOG_FILE, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-            if not file_exists:
-                writer.writerow(CSV_HEADER)
-            
-            row_data = [data.get(header, '') for header in CSV_HEADER]
-            writer.writerow(row_data)
+        return tiktoken.get_encoding("cl100k_base")
     except Exception as e:
-        logger.error(f"Failed to write to performance log CSV: {str(e)}")
+        logger.error(f"tiktoken encoding unavailable, using the approximate token count: {str(e)}")
+        return None
 
 def estimate_tokens(text):
     """Estimates the number of tokens in a given text."""
     if not isinstance(text, str):
         return 0
-    if tiktoken_available:
-        try:
-            encoding = tiktoken.get_encoding("cl100k_base")
-            return len(encoding.encode(text))
-        except Exception:
-            pass
+    encoding = _token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
     words = len(text.split())
     chars = len(text)
     return math.ceil((chars / 4 + words / 0.75) / 2)
@@ -97,18 +138,20 @@ llm = ChatOpenAI(
     model="gpt-3.5-turbo",
     api_key=os.getenv('OPENAI_API_KEY'),
     temperature=0.0,
-    max_tokens=4096
+    max_tokens=4096,
+    stream_usage=True
 )
 
-# Prompts
-sql_prompt_template = PromptTemplate.from_template(
-    """
+# Prompts: static instructions, schema and examples first, so every request shares the same prefix
+# for provider-side prompt caching; the per-request variables come last
+sql_prompt = CompiledPrompt(
+    static_text="""
     Instructions:
     - You are a FinOps expert, focused on answering questions about public cloud billing (AWS, Azure, GCP, Oracle Cloud).
     - Your goal is to understand the user's query and convert it into valid DuckDB SQL queries, using ONLY the `consolidated_billing` table.
     - Generate ONLY the SQL query, without explanations or comments.
     - For cost-related questions, ALWAYS include `SUM(BilledCost) AS total_cost` in the SELECT statement.
-    - For questions with "top consumers" or "top application" or "main" or "top whatever", sort by `total_cost` in descending order (`ORDER BY total_cost DESC`) and use `LIMIT {top_k}` if not specified the limit in the question itself (e.g.'top 2' or 'top four' and so on).
+    - For questions with "top consumers" or "top application" or "main" or "top whatever", sort by `total_cost` in descending order (`ORDER BY total_cost DESC`) and use `LIMIT` with the Top K given below if not specified the limit in the question itself (e.g.'top 2' or 'top four' and so on).
     - For questions about the "Top consuming Provider" or "top consuming service" or "top consuming category", always in the singular, show the single Top 1 value being asked.
     - For simple total cost questions (e.g., 'consumption in January'), use only `SUM(BilledCost) AS total_cost` without a GROUP BY.
     - For questions by service (e.g., 'cost of S3'), filter by `ServiceName` and group by `ServiceName`.
@@ -120,8 +163,8 @@ sql_prompt_template = PromptTemplate.from_template(
     - For cost per unit (e.g., 'cost per GB'), use `SUM(BilledCost) / SUM(ConsumedQuantity)` if `ConsumedQuantity` and `ConsumedUnit` are available.
     - For comparisons or trends (e.g., 'month-over-month comparison'), use `date_trunc('month', BillingPeriodStart)` and group by the period, covering the entire dataset range.
     - If the period is not specified and the context does not indicate a month, do not add a date filter (use the entire dataset).
-    - If a month is specified without a year (e.g., 'December'), use the most recent year available in the dataset, based on the context: {context}.
-    - For sequential questions (e.g., 'and in February'), reuse the context: {context}.
+    - If a month is specified without a year (e.g., 'December'), use the most recent year available in the dataset, based on the Context given below.
+    - For sequential questions (e.g., 'and in February'), reuse the Context given below.
     - Never use `SELECT *`. Choose relevant columns.
     - Never perform data modifications (`INSERT`, `UPDATE`, `DELETE`).
     - If `ConsumedQuantity` or `ConsumedUnit` are mentioned but not applicable, ignore them.
@@ -144,37 +187,21 @@ sql_prompt_template = PromptTemplate.from_template(
     - tag_environment: string (environment, e.g., 'dev', 'prod', can be NULL)
     - tag_business_unit: string (business unit, e.g., 'ChicagoIT', can be NULL)
 
-    Examples:
-    - Question: "How much did we spend on S3 in us-east-1?"
-      SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName = 'Amazon Simple Storage Service' AND RegionId = 'us-east-1' GROUP BY ServiceName LIMIT 5;
-    - Question: "What was the cost of EC2 and EKS?"
-      SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceName IN ('Amazon Elastic Compute Cloud', 'Amazon Elastic Kubernetes Services') GROUP BY ServiceName LIMIT 5;
-    - Question: "Which services spent the most in the United States last month?"
-      SELECT ServiceName, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE RegionId IN ('us-east-1', 'us-west-1', 'us-west-2') AND BillingPeriodStart >= '2024-09-01' AND BillingPeriodStart < '2024-10-01' GROUP BY ServiceName ORDER BY total_cost DESC LIMIT 5;
-    - Question: "What was the consumption in January 2024?"
-      SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE BillingPeriodStart >= '2024-01-01' AND BillingPeriodStart < '2024-02-01';
-    - Question: "What is the month-over-month consumption comparison?"
-      SELECT date_trunc('month', BillingPeriodStart) AS month, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY date_trunc('month', BillingPeriodStart) ORDER BY month;
-    - Question: "What is the total cloud consumption?"
-      SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing;
-    - Question: "Which applications consumed the most compute services?"
-      SELECT tag_application, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceCategory = 'Compute' GROUP BY tag_application ORDER BY total_cost DESC LIMIT 5;
-    - Question: "Cost by application and environment"
-      SELECT tag_application, tag_environment, SUM(BilledCost) AS total_cost FROM consolidated_billing GROUP BY tag_application, tag_environment ORDER BY total_cost DESC LIMIT 5;
-    - Question: "Cost of compute in the AWS provider?"
-      SELECT ServiceCategory, SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ServiceCategory = 'Compute' AND ProviderName = 'AWS' GROUP BY ServiceCategory LIMIT 5;
-    - Question: "What is the total consumption of Azure?"
-      SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing WHERE ProviderName = 'Microsoft';
+""",
+    dynamic_template="""    Examples:
+{examples}
 
     Question: {question}
     Table Info: {table_info}
     Top K: {top_k}
     Context: {context}
     Generate the corresponding SQL query.
-    """
+    """,
+    count_tokens=estimate_tokens
 )
-response_prompt_template = PromptTemplate.from_template(
-    """
+sql_prompt_template = sql_prompt.template
+response_prompt = CompiledPrompt(
+    static_text="""
     You are a FinOps expert, helping to interpret cloud cost data. Based on the user's question, the SQL query results, and the context, generate a short, objective, natural language response. Use the format "A: [answer]". Include only the cost value, service, region, tags, provider, or category (if applicable), and period (if specified). Avoid recommendations or additional details. If the result is empty, state that there is no data.
 
     Formatting Rules:
@@ -188,162 +215,405 @@ response_prompt_template = PromptTemplate.from_template(
     - For grouping by multiple dimensions (e.g., 'cost by application and environment'), report: "[tag_application]/[tag_environment]: $XXX."
     - For comparisons or trends, list the costs by month: "A: [month/year]: $XXX; [month/year]: $YYY; ..."
 
-    Question: {question}
-    SQL Result: {sql_result}
-    Context: {context}
-
     Example:
     - Question: "How much did we spend on EC2 and EKS?"
       SQL Result: [('Amazon Elastic Compute Cloud', 88.28), ('Amazon Elastic Kubernetes Services', 50.00)]
-      Context: {{'period_start': '2024-06-01', 'period_end': '2024-07-01'}}
+      Context: {'period_start': '2024-06-01', 'period_end': '2024-07-01'}
       Answer: A: Amazon Elastic Compute Cloud: $88.28; Amazon Elastic Kubernetes Services: $50.00.
     - Question: "Which services spent the most in the United States last month?"
       SQL Result: [('Amazon Elastic Compute Cloud', 76.90), ('Amazon Relational Database Service', 9.77)]
-      Context: {{'period_start': '2024-09-01', 'period_end': '2024-10-01'}}
+      Context: {'period_start': '2024-09-01', 'period_end': '2024-10-01'}
       Answer: A: Amazon Elastic Compute Cloud: $76.90; Amazon Relational Database Service: $9.77 in September 2024.
     - Question: "What was the consumption in January 2024?"
       SQL Result: [(1234.56,)]
-      Context: {{'period_start': '2024-01-01', 'period_end': '2024-02-01'}}
+      Context: {'period_start': '2024-01-01', 'period_end': '2024-02-01'}
       Answer: A: In January 2024, the total cost was $1,234.56.
 
+""",
+    dynamic_template="""    Question: {question}
+    SQL Result: {sql_result}
+    Context: {context}
+
     Answer:
-    """
+    """,
+    count_tokens=estimate_tokens
 )
+response_prompt_template = response_prompt.template
+
+# Few-shot examples retrieved per question (BM25 over the example questions) instead of a fixed list
+FEW_SHOT_ENABLED = True
+FEW_SHOT_K = 4
+FEW_SHOT_EXAMPLES_FILE = os.path.join(os.path.dirname(__file__), 'few_shot_examples.json')  # optional curated {"question", "sql"} list
+example_library = ExampleLibrary(SEED_EXAMPLES)
+
+def _load_example_library():
+    example_library.add_many(load_examples_file(FEW_SHOT_EXAMPLES_FILE))
+    example_library.add_many(load_performance_log_examples(PERFORMANCE_LOG_DIR))
+    logger.info(f"Few-shot example library loaded with {len(example_library)} examples")
+
+def select_examples(question):
+    if not FEW_SHOT_ENABLED:
+        return format_examples((e["question"], e["sql"]) for e in SEED_EXAMPLES)
+    return format_examples(example_library.search(question, FEW_SHOT_K))
+
+if FEW_SHOT_ENABLED:
+    _background_executor.submit(_load_example_library)
+
+# Tokenize the static prefixes once, off the first request
+for _prompt in (sql_prompt, response_prompt):
+    _background_executor.submit(lambda prompt=_prompt: prompt.static_tokens)
+
+SQL_PROMPT_HASH = performance_log.register_prompt(sql_prompt_template.template)
+RESPONSE_PROMPT_HASH = performance_log.register_prompt(response_prompt_template.template)
 
 # Included helper functions
 def get_dataset_date_range():
-    con = get_duckdb_connection()
     try:
-        query = "SELECT MIN(BillingPeriodStart)::TIMESTAMP, MAX(BillingPeriodStart)::TIMESTAMP FROM consolidated_billing"
-        return con.execute(query).fetchone()
+        metadata = get_dataset_metadata()
+        return metadata['min_date'], metadata['max_date']
     except Exception as e:
         logger.error(f"Error getting date range: {str(e)}")
         return None, None
-    finally:
-        con.close()
 
-def get_last_year_for_month(month_num):
-    con = get_duckdb_connection()
+def _run_sync(coroutine):
+    """Runs a coroutine to completion from synchronous code, even if the calling thread already runs an event loop."""
     try:
-        query = f"SELECT MAX(strftime(BillingPeriodStart::TIMESTAMP, '%Y')) FROM consolidated_billing WHERE strftime(BillingPeriodStart::TIMESTAMP, '%m') = '{month_num}'"
-        return con.execute(query).fetchone()[0]
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(contextvars.copy_context().run, asyncio.run, coroutine).result()
+
+_extractor_lock = threading.Lock()
+_extractor_cache = {"version": None, "extractor": None}
+
+def get_entity_extractor():
+    """Returns the entity extractor compiled from the dataset's distinct values, rebuilt only when the dataset version changes."""
+    try:
+        metadata = get_dataset_metadata()
     except Exception as e:
-        logger.error(f"Error getting last year for month {month_num}: {str(e)}")
-        return None
-    finally:
-        con.close()
-
-def preprocess_question(question):
-    question = question.lower()
-    month_mapping = {"january": "01", "february": "02", "march": "03", "april": "04", "may": "05", "june": "06", "july": "07", "august": "08", "september": "09", "october": "10", "november": "11", "december": "12"}
-    term_mapping = { "ec2": "ServiceName = 'Amazon Elastic Compute Cloud'", "s3": "ServiceName = 'Amazon Simple Storage Service'", "rds": "ServiceName = 'Amazon Relational Database Service'", "vm": "ServiceName = 'Microsoft Azure Virtual Machines'", "compute": "ServiceCategory = 'Compute'", "storage": "ServiceCategory = 'Storage'", "networking": "ServiceCategory = 'Networking'", "database": "ServiceCategory = 'Database'", "aws": "ProviderName = 'AWS'", "azure": "ProviderName = 'Microsoft'", "gcp": "ProviderName = 'Google Cloud'", "consumption": "cost", "top": "top consumers"}
-    # Simplified term mapping based on previous fixes
-    if 'question_context' not in st.session_state: st.session_state.question_context = {}
-    st.session_state.question_context.update({'service': None, 'category': None, 'region': None, 'provider': None, 'year': None, 'group_by': None, 'type': None, 'periods': None, 'analysis': None, 'period_start': None, 'period_end': None, 'tag_application': None, 'tag_environment': None, 'tag_business_unit': None})
+        logger.error(f"Error loading dataset values for the entity extractor: {str(e)}")
+        metadata = {"version": None, "distinct_values": {}, "month_years": {}}
+    with _extractor_lock:
+        if _extractor_cache["extractor"] is None or _extractor_cache["version"] != metadata["version"]:
+            start_time = time.time()
+            extractor = EntityExtractor(metadata["distinct_values"], metadata["month_years"])
+            logger.info(f"Entity extractor compiled with {len(extractor.phrases)} phrases in {(time.time() - start_time) * 1000:.0f} ms")
+            _extractor_cache.update(version=metadata["version"], extractor=extractor)
+        return _extractor_cache["extractor"]
+
+def preprocess_question(question, context=None):
+    """Rewrites the question for the LLM and extracts the entities (filters, period) it mentions.
+    The question context is updated in place; query_service.QuestionSession keeps one per conversation."""
+    context = {} if context is None else context
+    context.update({'service': None, 'category': None, 'region': None, 'provider': None, 'year': None, 'group_by': None, 'type': None, 'periods': None, 'analysis': None, 'period_start': None, 'period_end': None, 'tag_application': None, 'tag_environment': None, 'tag_business_unit': None, 'ambiguous': None})
+    question, entities = get_entity_extractor().extract(question)
     min_date, max_date = get_dataset_date_range()
     if min_date and max_date:
-        st.session_state.question_context['period_start'], st.session_state.question_context['period_end'] = min_date.strftime('%Y-%m-%d'), max_date.strftime('%Y-%m-%d')
-    has_explicit_year = re.search(r'\d{4}', question)
-    for month_name, month_num in month_mapping.items():
-        if month_name in question and not has_explicit_year:
-            last_year = get_last_year_for_month(month_num)
-            if last_year:
-                next_month = str(int(month_num) + 1).zfill(2) if int(month_num) < 12 else "01"
-                next_year = last_year if int(month_num) < 12 else str(int(last_year) + 1)
-                question = question.replace(month_name, f"BillingPeriodStart >= '{last_year}-{month_num}-01' AND BillingPeriodStart < '{next_year}-{next_month}-01'")
-    for term, replacement in term_mapping.items(): question = question.replace(term, replacement)
+        context['period_start'], context['period_end'] = min_date.strftime('%Y-%m-%d'), max_date.strftime('%Y-%m-%d')
+    if re.search(r"\blast month\b", question) and max_date:
+        entities['month_count'] += 1
+        entities['period'] = month_period(max_date.strftime('%Y'), max_date.strftime('%m'))
+        entities['terms'].append("last month")
+    if entities['period'] and entities['month_count'] == 1:
+        context['period_start'], context['period_end'] = entities['period']
+        context['periods'] = [entities['period']]
+    for context_key, column in (('service', 'ServiceName'), ('category', 'ServiceCategory'), ('provider', 'ProviderName'), ('region', 'RegionId'),
+                                ('tag_application', 'tag_application'), ('tag_environment', 'tag_environment'), ('tag_business_unit', 'tag_business_unit')):
+        context[context_key] = entities['filters'].get(column)
+    context['ambiguous'] = entities['ambiguous'] or None
     logger.info(f"Preprocessed question: {question}")
-    return question
+    return question, entities
 
 def validate_query(sql_query):
-    if "select" in sql_query.lower() and "from consolidated_billing" not in sql_query.lower():
-        logger.error("Invalid query: does not use the consolidated_billing table")
-        return False
-    return True
+    """Returns (sql, error, action) for generated SQL: the SQL to run, possibly with a LIMIT added,
+    or the reason it was rejected. See sql_guard.check_query."""
+    with duckdb_cursor() as con:
+        sql_query, error, action = check_query(con, sql_query, SQL_GUARD_ALLOWED_TABLES, SQL_GUARD_MAX_PLAN_ROWS, SQL_GUARD_LIMIT_ROWS)
+    if error:
+        logger.error(f"Invalid query: {error}")
+    return sql_query, error, action
 
-def generate_sql(question, table_info, top_k=3):
-    processed_question = preprocess_question(question)
+def _preprocess_question_traced(question, context):
+    with span("preprocess_question"):
+        return preprocess_question(question, context)
+
+def _build_sql_prompt(question, processed_question, table_info, top_k, filtered_context):
+    with span("build_prompt") as current:
+        prompt_input = {"question": processed_question, "table_info": table_info, "top_k": top_k, "context": str(filtered_context), "examples": select_examples(question)}
+        prompt_text = sql_prompt.format(**prompt_input)
+        token_count = sql_prompt.token_count(**prompt_input)
+        if current:
+            current.set_attribute("prompt_tokens", token_count)
+    return prompt_input, prompt_text, token_count
+
+def _lookup_sql_cache(processed_question, filtered_context, top_k):
+    with span("sql_cache_lookup") as current:
+        cache_key = make_cache_key(processed_question, filtered_context, top_k, get_dataset_version())
+        cached_sql = sql_cache.get(cache_key)
+        if current:
+            current.set_attribute("hit", bool(cached_sql))
+    return cache_key, cached_sql
+
+@traced("generate_sql")
+async def generate_sql_async(question, table_info, top_k=3, context=None):
+    context = {} if context is None else context
+    # Entity extraction, and the metadata load of the first question of a dataset version, run off the event loop
+    processed_question, entities = await asyncio.to_thread(_preprocess_question_traced, question, context)
+    sql_meta = {'sql_source': 'llm', 'template_confidence': '', 'sql_cache_hit': False}
+    if TEMPLATE_SQL_ENABLED:
+        with span("template_sql") as current:
+            template_sql, confidence, shape = compile_template_sql(question, entities, top_k)
+            if current:
+                current.set_attribute("shape", shape or "")
+                current.set_attribute("confidence", confidence)
+        sql_meta['template_confidence'] = round(confidence, 3)
+        if template_sql and confidence >= TEMPLATE_SQL_MIN_CONFIDENCE:
+            logger.info(f"Template SQL ({shape}, confidence {confidence:.2f}): {template_sql}")
+            sql_meta['sql_source'] = 'template'
+            return template_sql, None, "", 0, sql_meta
     chain = sql_prompt_template | llm
-    context = st.session_state.get('question_context', {})
     filtered_context = {k: v for k, v in context.items() if v is not None}
-    prompt_input = {"question": processed_question, "table_info": table_info, "top_k": top_k, "context": str(filtered_context)}
-    prompt_text = sql_prompt_template.format(**prompt_input)
-    token_count = estimate_tokens(prompt_text)
+    # Both only depend on the preprocessed question: the prompt (few-shot retrieval and token count) is built
+    # while the dataset version and the SQL cache are looked up
+    (prompt_input, prompt_text, token_count), (cache_key, cached_sql) = await asyncio.gather(
+        asyncio.to_thread(_build_sql_prompt, question, processed_question, table_info, top_k, filtered_context),
+        asyncio.to_thread(_lookup_sql_cache, processed_question, filtered_context, top_k)
+    )
+    sql_meta.update({'prompt_1_hash': SQL_PROMPT_HASH, 'prompt_1_variables': json.dumps(prompt_input, default=str)})
+    stats = sql_cache.stats()
+    logger.info(f"SQL cache {'hit' if cached_sql else 'miss'} (hits={stats['hits']}, misses={stats['misses']})")
+    if cached_sql:
+        sql_meta.update({'sql_source': 'cache', 'sql_cache_hit': True})
+        return cached_sql, None, prompt_text, token_count, sql_meta
     try:
-        sql_query_response = chain.invoke(prompt_input).content
+        with span("llm_sql") as current:
+            message = await chain.ainvoke(prompt_input)
+            llm_tokens, cached_tokens = usage_details(message)
+            sql_meta.update({'prompt_1_llm_tokens': llm_tokens, 'prompt_1_cached_tokens': cached_tokens})
+            if current:
+                current.set_attribute("input_tokens", llm_tokens)
+                current.set_attribute("cached_input_tokens", cached_tokens)
+        sql_query_response = message.content
         sql_query = sql_query_response.strip("```sql").strip()
-        if not validate_query(sql_query):
-            return None, "A: Invalid query generated.", prompt_text, token_count
-        return sql_query, None, prompt_text, token_count
+        with span("validate_query") as current:
+            sql_query, error, action = await asyncio.to_thread(validate_query, sql_query)
+            if current:
+                current.set_attribute("action", action)
+        sql_meta['sql_guard'] = action
+        if error:
+            return None, "A: Invalid query generated.", prompt_text, token_count, sql_meta
+        _background_executor.submit(sql_cache.set, cache_key, sql_query)
+        return sql_query, None, prompt_text, token_count, sql_meta
     except Exception as e:
         logger.error(f"Error generating SQL: {str(e)}")
-        return None, f"A: Error processing question: {str(e)}", prompt_text, token_count
+        return None, f"A: Error processing question: {str(e)}", prompt_text, token_count, sql_meta
 
+def generate_sql(question, table_info, top_k=3, context=None):
+    context = {} if context is None else context
+    return _run_sync(generate_sql_async(question, table_info, top_k, context))
+
+def _fetch_bounded(con, sql_query):
+    con.execute(sql_query)
+    return fetch_bounded(con, RESULT_MAX_ROWS, RESULT_MAX_BYTES, RESULT_SUMMARY_TOP_N)
+
+def _fetch(con, sql_query):
+    """Runs the query and returns (rows, columns, summary), attaching DuckDB's profile to the current span if enabled."""
+    current = current_span()
+    if not TRACE_DUCKDB_PROFILE or current is None:
+        return _fetch_bounded(con, sql_query)
+    con.execute("SET enable_profiling = 'no_output'")
+    try:
+        result, columns, summary = _fetch_bounded(con, sql_query)
+        try:
+            current.set_attribute("duckdb_profile", json.loads(con.get_profiling_information(format="json")))
+        except Exception as e:
+            logger.error(f"Error reading DuckDB profile: {str(e)}")
+        return result, columns, summary
+    finally:
+        con.execute("RESET enable_profiling")
+
+@traced("execute_query")
 def execute_query(sql_query):
-    if not sql_query: return None, 0
-    con = get_duckdb_connection()
+    """Returns (rows, execution ms, cache hit, columns, summary). rows is capped at RESULT_MAX_ROWS /
+    RESULT_MAX_BYTES; summary (see query_results.fetch_bounded) covers the full result."""
+    if not sql_query: return None, 0, False, [], None
     try:
-        start_time = time.time()
-        result = con.execute(sql_query).fetchall()
-        execution_time_ms = (time.time() - start_time) * 1000
-        return result, execution_time_ms
+        # A new consolidation changes the dataset version and invalidates every cached result
+        result_cache.ensure_version(get_dataset_version())
+        cache_key = canonicalize_sql(sql_query)
+        with span("result_cache_lookup") as current:
+            cached = result_cache.get(cache_key)
+            if current:
+                current.set_attribute("hit", cached is not None)
+        if cached is not None:
+            stats = result_cache.stats()
+            logger.info(f"Result cache hit (hits={stats['hits']}, misses={stats['misses']}, bytes={stats['bytes']})")
+            columns, result, summary = cached
+            return result, 0, True, columns, summary
+        with duckdb_cursor() as con, span("duckdb_execute") as current:
+            routed_query = route_query(sql_query)
+            start_time = time.time()
+            with query_timeout(con, QUERY_TIMEOUT_SECONDS):
+                result, columns, summary = _fetch(con, routed_query)
+            execution_time_ms = (time.time() - start_time) * 1000
+            if current:
+                current.set_attribute("rollup", routed_query != sql_query)
+                current.set_attribute("rows", summary["row_count"])
+                current.set_attribute("truncated", summary["truncated"])
+        result_cache.set(cache_key, (columns, result, summary))
+        return result, execution_time_ms, False, columns, summary
+    except QueryTimeout as e:
+        logger.error(f"Query timed out: '{sql_query}'. Error: {str(e)}")
+        return f"A: The query took longer than {QUERY_TIMEOUT_SECONDS} seconds and was cancelled.", 0, False, [], None
     except Exception as e:
         logger.error(f"Error executing query: '{sql_query}'. Error: {str(e)}")
-        return f"A: Error executing query: {str(e)}", 0
-    finally:
-        con.close()
+        return f"A: Error executing query: {str(e)}", 0, False, [], None
 
-def enhance_response(question, sql_result, context):
-    chain = response_prompt_template | llm
+async def execute_query_async(sql_query):
+    # DuckDB releases the GIL while executing, so a worker thread keeps the event loop free
+    return await asyncio.to_thread(execute_query, sql_query)
+
+def export_query_result(sql_query):
+    """Runs the query again without the row cap and returns the full result as CSV bytes, for download."""
+    try:
+        with duckdb_cursor() as con, span("export_query_result"), query_timeout(con, QUERY_TIMEOUT_SECONDS):
+            con.execute(route_query(sql_query))
+            return result_to_csv(con)
+    except Exception as e:
+        logger.error(f"Error exporting query result: '{sql_query}'. Error: {str(e)}")
+        return b""
+
+def _response_prompt_input(question, sql_result, context, summary=None):
     filtered_context = {k: v for k, v in context.items() if v is not None}
-    prompt_input = {"question": question, "sql_result": str(sql_result), "context": str(filtered_context)}
-    prompt_text = response_prompt_template.format(**prompt_input)
-    token_count = estimate_tokens(prompt_text)
+    sql_result = result_for_prompt(sql_result, summary, PROMPT_MAX_ROWS) if summary else str(sql_result)
+    return {"question": question, "sql_result": sql_result, "context": str(filtered_context)}
+
+@traced("enhance_response")
+async def enhance_response_async(question, sql_result, context, on_token=None, summary=None):
+    """Asks the LLM to phrase the SQL result, streaming each token to on_token as it arrives.
+    Large results (see execute_query's summary) reach the prompt as a summary instead of every row.
+    Also returns the input token usage reported by the provider, when available."""
+    chain = response_prompt_template | llm
+    prompt_input = _response_prompt_input(question, sql_result, context, summary)
+    prompt_text = response_prompt.format(**prompt_input)
+    token_count = response_prompt.token_count(**prompt_input)
     try:
         start_time = time.time()
-        response = chain.invoke(prompt_input).content
+        first_token_ms = None
+        parts = []
+        usage = {}
+        with span("llm_response", prompt_tokens=token_count) as current:
+            async for chunk in chain.astream(prompt_input):
+                llm_tokens, cached_tokens = usage_details(chunk)
+                if llm_tokens is not None:
+                    usage = {'prompt_2_llm_tokens': llm_tokens, 'prompt_2_cached_tokens': cached_tokens}
+                    if current:
+                        current.set_attribute("input_tokens", llm_tokens)
+                        current.set_attribute("cached_input_tokens", cached_tokens)
+                if not chunk.content:
+                    continue
+                if first_token_ms is None:
+                    first_token_ms = (time.time() - start_time) * 1000
+                    if current:
+                        current.set_attribute("first_token_ms", first_token_ms)
+                parts.append(chunk.content)
+                if on_token:
+                    on_token(chunk.content)
         response_time_ms = (time.time() - start_time) * 1000
-        return response, response_time_ms, token_count, prompt_text
+        return "".join(parts), response_time_ms, token_count, prompt_text, first_token_ms, usage
     except Exception as e:
         logger.error(f"Error enhancing response: {str(e)}")
-        return "A: Could not format response.", 0, token_count, prompt_text
+        return "A: Could not format response.", 0, token_count, prompt_text, None, {}
+
+def enhance_response(question, sql_result, context, on_token=None, summary=None):
+    return _run_sync(enhance_response_async(question, sql_result, context, on_token, summary))
 
-def format_response(question, result):
+@traced("format_response")
+async def format_response_async(question, result, columns=None, on_token=None, context=None, summary=None, sql_source=None):
     if isinstance(result, str):
-        return result, 0, 0, ""
-    context = st.session_state.get('question_context', {})
-    return enhance_response(question, result, context)
+        return result, 0, 0, "", {}
+    context = {} if context is None else context
+    format_meta = {'formatter': 'llm', 'local_format_time_ms': '', 'llm_2_first_token_ms': ''}
+    if summary:
+        format_meta.update({'result_row_count': summary['row_count'], 'result_truncated': summary['truncated']})
+    # A truncated result only holds part of the rows, so the local formatter would answer from partial data.
+    # Only template SQL is built from the context's filters and period; SQL from the LLM or the cache may
+    # filter differently, so the local formatter would describe a subject or period the query did not use.
+    if LOCAL_FORMATTER_ENABLED and sql_source == 'template' and not (summary and summary['truncated']):
+        start_time = time.time()
+        with span("local_format"):
+            answer = format_answer(question, result, columns, context)
+        format_meta['local_format_time_ms'] = (time.time() - start_time) * 1000
+        if answer:
+            format_meta['formatter'] = 'local'
+            if on_token:
+                on_token(answer)
+            return answer, 0, 0, "", format_meta
+    response, response_time_ms, token_count, prompt_text, first_token_ms, usage = await enhance_response_async(question, result, context, on_token, summary)
+    format_meta.update({
+        **usage,
+        'llm_2_first_token_ms': first_token_ms,
+        'prompt_2_hash': RESPONSE_PROMPT_HASH,
+        'prompt_2_variables': json.dumps(_response_prompt_input(question, result, context, summary), default=str)
+    })
+    return response, response_time_ms, token_count, prompt_text, format_meta
+
+def format_response(question, result, columns=None, on_token=None, context=None, summary=None, sql_source=None):
+    context = {} if context is None else context
+    return _run_sync(format_response_async(question, result, columns, on_token, context, summary, sql_source))
 
-def process_question(question, table_info="Table: consolidated_billing"):
+def _log_performance(perf_data, start_time, status='ok'):
+    # Only enqueues the record; the writer thread batches it to Parquet off the request path
+    perf_data.update({'total_time_ms': (time.time() - start_time) * 1000, 'status': status})
+    performance_log.submit(perf_data)
+
+async def process_question_async(question, table_info="Table: consolidated_billing", on_sql=None, on_token=None, context=None):
+    """Answers a question end to end on the running event loop. on_sql receives the SQL as soon as it is
+    known and on_token each piece of the answer as it is produced. Pass a separate context dict per
+    conversation to serve several questions concurrently on the same loop."""
+    context = {} if context is None else context
     request_id = str(uuid.uuid4())
+    start_time = time.time()
+    with tracer.trace("process_question", request_id=request_id):
+        return await _answer_question(question, table_info, on_sql, on_token, context, request_id, start_time)
+
+async def _answer_question(question, table_info, on_sql, on_token, context, request_id, start_time):
     logger.info(f"[{request_id}] USER QUESTION RECEIVED: \"{question}\"")
     perf_data = {'request_id': request_id, 'user_question': question}
     try:
-        sql_query, error, p1_text, p1_tokens = generate_sql(question, table_info)
-        perf_data.update({'prompt_1_text': p1_text, 'prompt_1_tokens': p1_tokens, 'llm_1_response_sql': sql_query if not error else error})
+        sql_query, error, _, p1_tokens, sql_meta = await generate_sql_async(question, table_info, context=context)
+        perf_data.update({'prompt_1_tokens': p1_tokens, 'llm_1_response_sql': sql_query if not error else error, **sql_meta})
         if error:
             perf_data['llm_2_final_response'] = error
-            log_performance_to_csv(perf_data)
+            _log_performance(perf_data, start_time, 'error')
             return sql_query, error
 
-        result, sql_time_ms = execute_query(sql_query)
-        perf_data['sql_execution_time_ms'] = f"{sql_time_ms:.0f}"
+        if on_sql:
+            on_sql(sql_query)
+        result, sql_time_ms, result_cache_hit, columns, summary = await execute_query_async(sql_query)
+        perf_data.update({'sql_execution_time_ms': sql_time_ms, 'result_cache_hit': result_cache_hit})
         if isinstance(result, str):
             error_msg = result
             perf_data['llm_2_final_response'] = error_msg
-            log_performance_to_csv(perf_data)
+            _log_performance(perf_data, start_time, 'error')
             return sql_query, error_msg
         
-        final_response, llm2_time_ms, p2_tokens, p2_text = format_response(question, result)
-        perf_data.update({'prompt_2_text': p2_text, 'prompt_2_tokens': p2_tokens, 'llm_2_response_time_ms': f"{llm2_time_ms:.0f}", 'llm_2_final_response': final_response})
+        final_response, llm2_time_ms, p2_tokens, _, format_meta = await format_response_async(question, result, columns, on_token, context, summary, sql_meta['sql_source'])
+        perf_data.update({'prompt_2_tokens': p2_tokens, 'llm_2_response_time_ms': llm2_time_ms or None, 'llm_2_final_response': final_response, **format_meta})
         
         logger.info(f"[{request_id}] Final formatted response: \"{final_response}\"")
-        log_performance_to_csv(perf_data)
+        _log_performance(perf_data, start_time)
         
         return sql_query, final_response
     except Exception as e:
         logger.critical(f"[{request_id}] Unexpected error in main flow: {str(e)}")
         error_msg = f"A: A critical error occurred: {str(e)}"
         perf_data['llm_2_final_response'] = error_msg
-        log_performance_to_csv(perf_data)
+        _log_performance(perf_data, start_time, 'error')
         return None, error_msg
+
+def process_question(question, table_info="Table: consolidated_billing", on_sql=None, on_token=None, context=None):
+    """Synchronous wrapper around process_question_async; the context defaults to a fresh dict."""
+    context = {} if context is None else context
+    return _run_sync(process_question_async(question, table_info, on_sql, on_token, context))
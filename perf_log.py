@@ -0,0 +1,260 @@
+import argparse
+import atexit
+import datetime
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import duckdb
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+# Performance records of the question pipeline, written off the request path by a background thread.
+# Records are batched into Parquet files rotated per day (<directory>/date=YYYY-MM-DD/part-*.parquet).
+# Prompts are stored once per template hash under <directory>/prompts; records keep only the hash and
+# the JSON of the variables rendered into the template.
+PERFORMANCE_LOG_SCHEMA = {
+    "timestamp": pl.Datetime("us"),
+    "request_id": pl.Utf8,
+    "user_question": pl.Utf8,
+    "status": pl.Utf8,
+    "sql_source": pl.Utf8,
+    "template_confidence": pl.Float64,
+    "sql_cache_hit": pl.Boolean,
+    "sql_guard": pl.Utf8,
+    "llm_1_response_sql": pl.Utf8,
+    "prompt_1_hash": pl.Utf8,
+    "prompt_1_variables": pl.Utf8,
+    "prompt_1_tokens": pl.Int64,
+    "prompt_1_llm_tokens": pl.Int64,
+    "prompt_1_cached_tokens": pl.Int64,
+    "sql_execution_time_ms": pl.Float64,
+    "result_cache_hit": pl.Boolean,
+    "result_row_count": pl.Int64,
+    "result_truncated": pl.Boolean,
+    "formatter": pl.Utf8,
+    "local_format_time_ms": pl.Float64,
+    "prompt_2_hash": pl.Utf8,
+    "prompt_2_variables": pl.Utf8,
+    "prompt_2_tokens": pl.Int64,
+    "prompt_2_llm_tokens": pl.Int64,
+    "prompt_2_cached_tokens": pl.Int64,
+    "llm_2_first_token_ms": pl.Float64,
+    "llm_2_response_time_ms": pl.Float64,
+    "llm_2_final_response": pl.Utf8,
+    "total_time_ms": pl.Float64,
+}
+PROMPT_SCHEMA = {"prompt_hash": pl.Utf8, "prompt_text": pl.Utf8, "first_seen": pl.Datetime("us")}
+# Latency columns reported by the summary
+STAGE_COLUMNS = ["sql_execution_time_ms", "local_format_time_ms", "llm_2_first_token_ms", "llm_2_response_time_ms", "total_time_ms"]
+
+
+def prompt_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _coerce(value, dtype):
+    if value is None or value == "":
+        return None
+    try:
+        if dtype == pl.Float64:
+            return float(value)
+        if dtype == pl.Int64:
+            return int(value)
+        if dtype == pl.Boolean:
+            return value if isinstance(value, bool) else str(value).lower() == "true"
+        if isinstance(dtype, pl.Datetime):
+            return value
+        return str(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PerformanceLogWriter:
+    """Queues performance records and writes them in batches from a daemon thread.
+
+    submit() never blocks: when the queue is full the record is dropped and counted. Day directories
+    older than retention_days are deleted when the writer rotates to a new day.
+    """
+
+    def __init__(self, directory, batch_size=200, flush_interval=5.0, max_queue=10000, retention_days=90):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._prompts = {}
+        self._written_prompts = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._current_day = None
+
+    def register_prompt(self, text):
+        """Returns the hash of a prompt template; its text is written once to the prompts table."""
+        digest = prompt_hash(text)
+        with self._lock:
+            self._prompts.setdefault(digest, text)
+        return digest
+
+    def submit(self, record):
+        self._start()
+        try:
+            self._queue.put_nowait(dict(record, timestamp=record.get("timestamp") or datetime.datetime.now()))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Performance log queue full; {self.dropped} records dropped so far")
+
+    def flush(self, timeout=None):
+        """Blocks until every record submitted so far has been written."""
+        if self._thread is None:
+            return
+        self._queue.put(_FLUSH)
+        if timeout is None:
+            self._queue.join()
+        else:
+            self._wait(timeout)
+
+    def _wait(self, timeout):
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="performance-log-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush, 5.0)
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.time(), 0.01))
+            except queue.Empty:
+                item = None
+            if item is not None and item is not _FLUSH:
+                batch.append(item)
+            if item is _FLUSH or len(batch) >= self.batch_size or time.time() >= deadline:
+                if batch:
+                    self._write_batch(batch)
+                    for _ in batch:
+                        self._queue.task_done()
+                    batch = []
+                deadline = time.time() + self.flush_interval
+            if item is _FLUSH:
+                self._queue.task_done()
+
+    def _write_batch(self, records):
+        try:
+            day = records[0]["timestamp"].strftime("%Y-%m-%d")
+            if day != self._current_day:
+                self._current_day = day
+                self._apply_retention()
+            self._write_prompts()
+            rows = {column: [_coerce(r.get(column), dtype) for r in records] for column, dtype in PERFORMANCE_LOG_SCHEMA.items()}
+            day_directory = os.path.join(self.directory, f"date={day}")
+            os.makedirs(day_directory, exist_ok=True)
+            part_file = os.path.join(day_directory, f"part-{time.strftime('%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet")
+            pl.DataFrame(rows, schema=PERFORMANCE_LOG_SCHEMA).write_parquet(part_file + ".tmp")
+            os.replace(part_file + ".tmp", part_file)
+        except Exception as e:
+            logger.error(f"Failed to write {len(records)} performance records: {str(e)}")
+
+    def _write_prompts(self):
+        with self._lock:
+            pending = {h: t for h, t in self._prompts.items() if h not in self._written_prompts}
+        if not pending:
+            return
+        prompts_directory = os.path.join(self.directory, "prompts")
+        os.makedirs(prompts_directory, exist_ok=True)
+        now = datetime.datetime.now()
+        existing = set()
+        if any(name.endswith(".parquet") for name in os.listdir(prompts_directory)):
+            existing = set(pl.scan_parquet(os.path.join(prompts_directory, "*.parquet")).select("prompt_hash").collect()["prompt_hash"])
+        new = {h: t for h, t in pending.items() if h not in existing}
+        if new:
+            part_file = os.path.join(prompts_directory, f"prompts-{uuid.uuid4().hex[:8]}.parquet")
+            pl.DataFrame(
+                {"prompt_hash": list(new), "prompt_text": list(new.values()), "first_seen": [now] * len(new)},
+                schema=PROMPT_SCHEMA
+            ).write_parquet(part_file + ".tmp")
+            os.replace(part_file + ".tmp", part_file)
+        self._written_prompts.update(pending)
+
+    def _apply_retention(self):
+        if not self.retention_days or not os.path.isdir(self.directory):
+            return
+        cutoff = (datetime.date.today() - datetime.timedelta(days=self.retention_days)).strftime("%Y-%m-%d")
+        for name in os.listdir(self.directory):
+            if name.startswith("date=") and name[5:] < cutoff:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                logger.info(f"Performance log partition {name} removed (retention {self.retention_days} days)")
+
+
+_FLUSH = object()
+
+
+def create_performance_views(con, directory):
+    """Registers the performance_log and performance_prompts views plus the summary views
+    performance_stage_latency and performance_daily on a DuckDB connection."""
+    records = os.path.join(directory, "date=*", "*.parquet").replace("'", "''")
+    prompts = os.path.join(directory, "prompts", "*.parquet").replace("'", "''")
+    con.execute(f"CREATE OR REPLACE VIEW performance_log AS SELECT * FROM read_parquet('{records}', hive_partitioning = true, union_by_name = true)")
+    con.execute(f"CREATE OR REPLACE VIEW performance_prompts AS SELECT DISTINCT ON (prompt_hash) * FROM read_parquet('{prompts}') ORDER BY prompt_hash, first_seen")
+    con.execute(f"""
+        CREATE OR REPLACE VIEW performance_stage_latency AS
+        SELECT stage, COUNT(*) AS requests,
+               quantile_cont(ms, 0.5) AS p50_ms, quantile_cont(ms, 0.95) AS p95_ms, MAX(ms) AS max_ms
+        FROM (UNPIVOT performance_log ON {", ".join(STAGE_COLUMNS)} INTO NAME stage VALUE ms)
+        GROUP BY stage ORDER BY stage
+    """)
+    con.execute("""
+        CREATE OR REPLACE VIEW performance_daily AS
+        SELECT CAST(timestamp AS DATE) AS day,
+               COUNT(*) AS requests,
+               SUM(COALESCE(prompt_1_tokens, 0)) AS prompt_1_tokens,
+               SUM(COALESCE(prompt_2_tokens, 0)) AS prompt_2_tokens,
+               SUM(COALESCE(prompt_1_llm_tokens, 0) + COALESCE(prompt_2_llm_tokens, 0)) AS llm_reported_tokens,
+               SUM(COALESCE(prompt_1_cached_tokens, 0) + COALESCE(prompt_2_cached_tokens, 0)) AS llm_cached_tokens,
+               AVG(CASE WHEN status = 'error' THEN 1 ELSE 0 END) AS error_rate,
+               AVG(CASE WHEN sql_source = 'llm' THEN 1 ELSE 0 END) AS llm_sql_rate,
+               AVG(CASE WHEN result_cache_hit THEN 1 ELSE 0 END) AS result_cache_hit_rate
+        FROM performance_log GROUP BY 1 ORDER BY 1
+    """)
+
+
+def performance_summary(directory):
+    """Returns the stage latency and daily summaries as lists of dicts."""
+    con = duckdb.connect()
+    try:
+        create_performance_views(con, directory)
+        summary = {}
+        for view in ("performance_stage_latency", "performance_daily"):
+            cursor = con.execute(f"SELECT * FROM {view}")
+            columns = [column[0] for column in cursor.description]
+            summary[view] = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        return summary
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summary of the question pipeline performance log.")
+    parser.add_argument("directory", nargs="?", default=os.path.join(os.path.dirname(__file__), "logs", "performance"))
+    args = parser.parse_args()
+    for view, rows in performance_summary(args.directory).items():
+        print(f"\n{view}")
+        for row in rows:
+            print("  " + ", ".join(f"{k}={round(v, 2) if isinstance(v, float) else v}" for k, v in row.items()))
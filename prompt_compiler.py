@@ -0,0 +1,47 @@
+import logging
+import threading
+
+from langchain_core.prompts import PromptTemplate
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledPrompt:
+    """Prompt split into a static prefix (instructions, schema, examples) and a dynamic suffix template.
+
+    The prefix holds no variables and always comes first, so the rendered prompts share a byte-identical
+    prefix that provider-side prompt caching can reuse. Its token count is computed once; each request
+    only tokenizes the rendered suffix.
+    """
+
+    def __init__(self, static_text, dynamic_template, count_tokens):
+        self.static_text = static_text
+        self.dynamic = PromptTemplate.from_template(dynamic_template)
+        self.count_tokens = count_tokens
+        # Literal braces of the static block are escaped so the whole prompt still works as one template
+        self.template = PromptTemplate.from_template(static_text.replace("{", "{{").replace("}", "}}") + dynamic_template)
+        self._static_tokens = None
+        self._lock = threading.Lock()
+
+    @property
+    def static_tokens(self):
+        if self._static_tokens is None:
+            with self._lock:
+                if self._static_tokens is None:
+                    self._static_tokens = self.count_tokens(self.static_text)
+        return self._static_tokens
+
+    def format(self, **variables):
+        return self.static_text + self.dynamic.format(**variables)
+
+    def token_count(self, **variables):
+        """Static prefix tokens (cached) plus the tokens of the rendered dynamic suffix."""
+        return self.static_tokens + self.count_tokens(self.dynamic.format(**variables))
+
+
+def usage_details(message):
+    """Returns (input_tokens, cached_input_tokens) reported by the provider for a response, or (None, None)."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    input_tokens = usage.get("input_tokens")
+    cached_tokens = (usage.get("input_token_details") or {}).get("cache_read")
+    return input_tokens, cached_tokens
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts):
+    """Builds a stable hash key from JSON-serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def canonicalize_sql(sql):
+    """Normalizes whitespace, case (outside string literals) and trailing semicolons of a SQL statement."""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(";").strip())
+    return "".join(part if part.startswith("'") else re.sub(r"\s+", " ", part).lower() for part in parts)
+
+
+def estimate_size(value):
+    """Approximates the memory footprint in bytes of a value made of nested lists/tuples of scalars."""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class TTLCache:
+    """Thread-safe LRU cache with optional TTL, an optional memory budget and an optional SQLite backend
+    that survives restarts.
+
+    Values written to disk must be JSON-serializable. With max_bytes set, least recently used entries are
+    evicted until the sizes reported by sizeof fit the budget.
+    """
+
+    def __init__(self, name, max_entries=1000, ttl_seconds=None, disk_path=None, max_bytes=None, sizeof=estimate_size):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_path = disk_path
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            with self._connect() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.disk_path, timeout=5)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _expired(self, created):
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def _read_disk(self, key):
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row and not self._expired(row[1]):
+                return json.loads(row[0]), row[1]
+        except Exception as e:
+            logger.error(f"Error reading {self.name} cache from disk: {str(e)}")
+        return None
+
+    def _write_disk(self, key, value, created):
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (key, json.dumps(value), created))
+                if self.ttl_seconds is not None:
+                    db.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl_seconds,))
+        except Exception as e:
+            logger.error(f"Error writing {self.name} cache to disk: {str(e)}")
+
+    def _evict(self, key):
+        _, _, size = self._entries.pop(key)
+        self.total_bytes -= size
+
+    def _store(self, key, value, created):
+        if key in self._entries:
+            self._evict(key)
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            logger.info(f"Value of {size} bytes exceeds the {self.name} cache budget; not cached")
+            return
+        self._entries[key] = (value, created, size)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+            self._evict(next(iter(self._entries)))
+
+    def get(self, key):
+        """Returns the cached value or None, counting the lookup as a hit or a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._expired(entry[1]):
+                self._evict(key)
+                entry = None
+            if entry is None and self.disk_path:
+                entry = self._read_disk(key)
+                if entry is not None:
+                    self._store(key, *entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        created = time.time()
+        with self._lock:
+            self._store(key, value, created)
+            if self.disk_path:
+                self._write_disk(key, value, created)
+
+    def ensure_version(self, version):
+        """Drops every entry when the dataset version differs from the one the cached values were computed on."""
+        with self._lock:
+            if self.version == version:
+                return
+            if self.version is not None:
+                logger.info(f"Dataset version changed; invalidating {self.name} cache ({len(self._entries)} entries)")
+            self.version = version
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+            if self.disk_path:
+                with self._connect() as db:
+                    db.execute("DELETE FROM cache")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.total_bytes}
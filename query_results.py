@@ -0,0 +1,134 @@
+import heapq
+import io
+import itertools
+import logging
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+logger = logging.getLogger(__name__)
+
+# Bounded fetching of query results as Arrow batches. At most max_rows rows / max_bytes bytes are kept;
+# the summary (row count, total/min/max and top-N of the measure column) always covers the whole result.
+BATCH_ROWS = 10000
+
+
+def _record_batch_reader(cursor, batch_rows):
+    # to_arrow_reader replaces fetch_record_batch in recent DuckDB releases
+    if hasattr(cursor, "to_arrow_reader"):
+        return cursor.to_arrow_reader(batch_rows)
+    return cursor.fetch_record_batch(batch_rows)
+
+
+def fetch_arrow_table(cursor):
+    """Reads the whole pending result of cursor as one Arrow table."""
+    if hasattr(cursor, "to_arrow_table"):
+        return cursor.to_arrow_table()
+    return cursor.fetch_arrow_table()
+
+
+def _measure_index(schema):
+    # The measure is the last numeric column, as in the answer formats of the response prompt
+    for index in range(len(schema) - 1, -1, -1):
+        field_type = schema.field(index).type
+        if pa.types.is_integer(field_type) or pa.types.is_floating(field_type) or pa.types.is_decimal(field_type):
+            return index
+    return None
+
+
+def _to_rows(table_or_batch):
+    return list(zip(*(column.to_pylist() for column in table_or_batch.columns)))
+
+
+def fetch_bounded(cursor, max_rows, max_bytes, top_n=10, batch_rows=BATCH_ROWS):
+    """Reads the pending result of cursor in Arrow batches. Returns (rows, columns, summary); rows holds
+    at most max_rows rows and max_bytes bytes, while summary describes every row of the result."""
+    reader = _record_batch_reader(cursor, batch_rows)
+    schema = reader.schema
+    measure = _measure_index(schema)
+    kept, kept_rows, kept_bytes = [], 0, 0
+    truncated = False
+    row_count, total, minimum, maximum = 0, None, None, None
+    top = []  # min-heap of (measure value, sequence, row) holding the top_n largest rows
+    sequence = itertools.count()
+    for batch in reader:
+        if batch.num_rows == 0:
+            continue
+        row_count += batch.num_rows
+        if measure is not None:
+            values = batch.column(measure)
+            batch_sum = pc.sum(values).as_py()
+            if batch_sum is not None:
+                total = batch_sum if total is None else total + batch_sum
+            batch_min, batch_max = pc.min_max(values).values()
+            if batch_min.is_valid:
+                minimum = batch_min.as_py() if minimum is None else min(minimum, batch_min.as_py())
+                maximum = batch_max.as_py() if maximum is None else max(maximum, batch_max.as_py())
+            indices = pc.select_k_unstable(batch, k=min(top_n, batch.num_rows), sort_keys=[(schema.names[measure], "descending")])
+            for row in _to_rows(batch.take(indices)):
+                if row[measure] is None:
+                    continue
+                entry = (row[measure], -next(sequence), row)
+                if len(top) < top_n:
+                    heapq.heappush(top, entry)
+                elif entry[0] > top[0][0]:
+                    heapq.heapreplace(top, entry)
+        if truncated:
+            continue
+        # Rows that still fit both caps, estimating the size of a row from the batch average
+        row_bytes = batch.nbytes / batch.num_rows
+        fit = min(max_rows - kept_rows, int((max_bytes - kept_bytes) // row_bytes) if row_bytes else batch.num_rows)
+        if fit < batch.num_rows:
+            truncated = True
+        if fit > 0:
+            part = batch.slice(0, fit) if fit < batch.num_rows else batch
+            kept.append(part)
+            kept_rows += part.num_rows
+            kept_bytes += part.num_rows * row_bytes
+    rows = _to_rows(pa.Table.from_batches(kept, schema)) if kept else []
+    if measure is not None:
+        top_rows = [row for _, _, row in sorted(top, reverse=True)]
+        top_total = sum(row[measure] for row in top_rows)
+    else:
+        top_rows, top_total = rows[:top_n], None
+    summary = {
+        "columns": list(schema.names),
+        "row_count": row_count,
+        "returned_rows": len(rows),
+        "truncated": truncated,
+        "measure": schema.names[measure] if measure is not None else None,
+        "total": total,
+        "min": minimum,
+        "max": maximum,
+        "top": top_rows,
+        "other_total": total - top_total if total is not None and top_total is not None else None,
+    }
+    if truncated:
+        logger.info(f"Query result truncated to {len(rows)} of {row_count} rows ({int(kept_bytes)} bytes kept)")
+    return rows, list(schema.names), summary
+
+
+def result_for_prompt(rows, summary, max_rows):
+    """Text of the SQL result for the response prompt: the rows themselves when there are at most
+    max_rows of them, otherwise a compact summary with the top-N rows and an "other" total."""
+    if not summary or summary["row_count"] <= max_rows and not summary["truncated"]:
+        return str(rows)
+    parts = [f"{summary['row_count']} rows with columns {summary['columns']}"]
+    if summary["measure"]:
+        parts.append(f"top {len(summary['top'])} by {summary['measure']}: {summary['top']}")
+        parts.append(f"other {summary['row_count'] - len(summary['top'])} rows together: {summary['other_total']}")
+        parts.append(f"overall {summary['measure']}: {summary['total']} (min {summary['min']}, max {summary['max']})")
+    else:
+        parts.append(f"first {len(summary['top'])} rows: {summary['top']}")
+    return "Summary of a large result - " + "; ".join(parts)
+
+
+def result_to_csv(cursor, batch_rows=BATCH_ROWS):
+    """Streams the pending result of cursor into CSV bytes, batch by batch."""
+    reader = _record_batch_reader(cursor, batch_rows)
+    buffer = io.BytesIO()
+    with pa_csv.CSVWriter(buffer, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+    return buffer.getvalue()
@@ -0,0 +1,288 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from data_processing import get_dataset_metadata
+from langchain_query import get_entity_extractor, process_question
+
+logger = logging.getLogger(__name__)
+
+# Headless backend for the chatbot. Questions run on a bounded worker pool, each worker borrowing its own
+# DuckDB cursor from the process pool (data_processing.duckdb_cursor), and the conversation state lives in
+# an explicit QuestionSession instead of a Streamlit session. Streamlit, the CLI, notebooks and bots share
+# one warm QueryService per process, in-process through get_service() or over local HTTP (--serve).
+SERVICE_MAX_WORKERS = 4
+SERVICE_MAX_PENDING = 16  # questions allowed to wait for a worker; beyond this submit() raises ServiceBusy
+SERVICE_QUEUE_TIMEOUT_SECONDS = 5  # how long submit() waits for room in the queue by default
+SESSION_IDLE_SECONDS = 60 * 60  # sessions unused for this long are dropped
+SESSION_HISTORY_MAX = 50
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class QuestionSession:
+    """Conversation state of one client: the question context used by langchain_query and the questions
+    answered so far. Questions of a session run one at a time, in the order they were submitted."""
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.context = {}
+        self.history = []
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+    def record(self, question, sql_query, answer):
+        self.history.append({"question": question, "sql": sql_query, "answer": answer})
+        del self.history[:-SESSION_HISTORY_MAX]
+
+
+class QueryService:
+    """Answers questions for many sessions on a bounded worker pool.
+
+    At most max_workers questions run at once and max_pending more wait for a worker; submit() waits up to
+    timeout seconds for room and then raises ServiceBusy, so callers get backpressure instead of an
+    unbounded queue.
+    """
+
+    def __init__(self, max_workers=SERVICE_MAX_WORKERS, max_pending=SERVICE_MAX_PENDING, table_info="Table: consolidated_billing"):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.table_info = table_info
+        self.rejected = 0
+        self.completed = 0
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="query-service")
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def warm(self):
+        """Loads the dataset metadata and compiles the entity extractor, so the first question pays neither."""
+        start_time = time.time()
+        get_dataset_metadata()
+        get_entity_extractor()
+        logger.info(f"Query service warmed in {(time.time() - start_time) * 1000:.0f} ms")
+
+    def session(self, session_id=None):
+        """Returns the session with session_id, creating it (with a new id when None) if it does not exist."""
+        now = time.time()
+        with self._lock:
+            for expired in [key for key, session in self._sessions.items() if now - session.last_used > SESSION_IDLE_SECONDS]:
+                del self._sessions[expired]
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = QuestionSession(session_id)
+                self._sessions[session.session_id] = session
+            session.last_used = now
+            return session
+
+    def close_session(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def submit(self, question, session_id=None, on_sql=None, on_token=None, timeout=SERVICE_QUEUE_TIMEOUT_SECONDS):
+        """Queues a question and returns a Future of (sql, answer), as from langchain_query.process_question.
+        on_sql and on_token are called from the worker thread."""
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.rejected += 1
+            raise ServiceBusy(f"{self.max_workers} questions running and {self.max_pending} waiting")
+        session = self.session(session_id)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            return self._executor.submit(self._answer, session, question, on_sql, on_token)
+        except Exception:
+            self._release()
+            raise
+
+    def ask(self, question, session_id=None, timeout=SERVICE_QUEUE_TIMEOUT_SECONDS):
+        """Answers a question and blocks until done. Returns (sql, answer)."""
+        return self.submit(question, session_id, timeout=timeout).result()
+
+    def stream(self, question, session_id=None, timeout=SERVICE_QUEUE_TIMEOUT_SECONDS):
+        """Answers a question, yielding ("sql", sql) and ("token", text) events in the calling thread as the
+        worker produces them, then ("answer", (sql, answer))."""
+        events = queue.Queue()
+        future = self.submit(question, session_id, on_sql=lambda sql: events.put(("sql", sql)), on_token=lambda token: events.put(("token", token)), timeout=timeout)
+        future.add_done_callback(lambda _: events.put(("done", None)))
+        while True:
+            kind, value = events.get()
+            if kind == "done":
+                break
+            yield kind, value
+        yield "answer", future.result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_pending": self.max_pending,
+                "in_flight": self._in_flight,
+                "sessions": len(self._sessions),
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _answer(self, session, question, on_sql, on_token):
+        try:
+            with session.lock:
+                sql_query, answer = process_question(question, self.table_info, on_sql, on_token, context=session.context)
+                session.record(question, sql_query, answer)
+                session.last_used = time.time()
+            return sql_query, answer
+        finally:
+            with self._lock:
+                self.completed += 1
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+
+_service_lock = threading.Lock()
+_service = None
+
+
+def get_service():
+    """Returns the process-wide QueryService, created and warmed on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = QueryService()
+            try:
+                _service.warm()
+            except Exception as e:
+                logger.error(f"Error warming the query service: {str(e)}")
+        return _service
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    # POST /sessions -> {"session_id"}; DELETE /sessions/<id>; POST /questions {"question", "session_id"}
+    # -> {"session_id", "sql", "answer"}; GET /health -> stats. A full queue answers 503 with Retry-After.
+    service = None
+
+    def _send(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, self.service.stats())
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            body = self._read_json()
+        except ValueError:
+            self._send(400, {"error": "invalid JSON body"})
+            return
+        if self.path == "/sessions":
+            self._send(201, {"session_id": self.service.session(body.get("session_id")).session_id})
+        elif self.path == "/questions":
+            question = str(body.get("question") or "").strip()
+            if not question:
+                self._send(400, {"error": "question is required"})
+                return
+            session_id = self.service.session(body.get("session_id")).session_id
+            try:
+                sql_query, answer = self.service.ask(question, session_id)
+            except ServiceBusy as e:
+                self._send(503, {"error": f"service busy: {str(e)}"}, {"Retry-After": str(SERVICE_QUEUE_TIMEOUT_SECONDS)})
+                return
+            except Exception as e:
+                logger.error(f"Error answering question over HTTP: {str(e)}")
+                self._send(500, {"error": str(e)})
+                return
+            self._send(200, {"session_id": session_id, "sql": sql_query, "answer": answer})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        if self.path.startswith("/sessions/"):
+            closed = self.service.close_session(self.path[len("/sessions/"):])
+            self._send(200 if closed else 404, {"closed": closed})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        logger.info(f"{self.address_string()} - {format % args}")
+
+
+def make_server(host=SERVICE_HOST, port=SERVICE_PORT, service=None):
+    """Returns a local HTTP server over service (the process-wide one by default); call serve_forever() on it."""
+    handler = type("ServiceHandler", (_ServiceHandler,), {"service": service or get_service()})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def ask_remote(question, session_id=None, url=f"http://{SERVICE_HOST}:{SERVICE_PORT}", timeout=None):
+    """Asks a question to a service started with --serve. Returns {"session_id", "sql", "answer"}."""
+    payload = json.dumps({"question": question, "session_id": session_id}).encode("utf-8")
+    request = urllib.request.Request(f"{url}/questions", data=payload, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the headless query service over local HTTP, or asks it a question.")
+    parser.add_argument("question", nargs="?", help="question to ask; omit with --serve")
+    parser.add_argument("--serve", action="store_true", help="start the HTTP service")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--url", help="ask a running service at this URL instead of answering in-process")
+    parser.add_argument("--session", help="session id to continue")
+    args = parser.parse_args()
+    if args.serve:
+        server = make_server(args.host, args.port)
+        logger.info(f"Query service listening on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            get_service().shutdown()
+    elif args.question:
+        if args.url:
+            print(json.dumps(ask_remote(args.question, args.session, args.url), indent=2))
+        else:
+            streamed = False
+            for kind, value in get_service().stream(args.question, args.session):
+                if kind == "sql":
+                    print(f"SQL: {value}")
+                elif kind == "token":
+                    streamed = True
+                    print(value, end="", flush=True)
+                elif not streamed:
+                    # Errors are returned as the answer without being streamed
+                    print(value[1], end="")
+            print()
+    else:
+        parser.error("pass a question or --serve")
@@ -0,0 +1,110 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pre-aggregated monthly cube over consolidated_billing, materialized in the DuckDB catalog at ingest time
+ROLLUP_TABLE = "billing_rollup"
+ROLLUP_DIMENSIONS = [
+    "ProviderName", "ServiceCategory", "ServiceName", "RegionId",
+    "SubAccountName", "tag_application", "tag_environment", "tag_business_unit"
+]
+# Columns a query may reference to be answered from the rollup. BillingPeriodStart is truncated to the month.
+ROLLUP_COLUMNS = set(c.lower() for c in ROLLUP_DIMENSIONS + ["BillingPeriodStart", "BilledCost"])
+# Raw line-item columns; a query touching any of them outside ROLLUP_COLUMNS must scan consolidated_billing
+RAW_COLUMNS = set(c.lower() for c in [
+    "BilledCost", "BillingPeriodStart", "BillingPeriodEnd", "ConsumedQuantity", "ConsumedUnit", "ProviderName",
+    "RegionId", "ResourceName", "ResourceType", "ResourceId", "ServiceCategory", "ServiceName", "SubAccountName",
+    "tag_application", "tag_environment", "tag_business_unit", "billing_month"
+])
+# Functions that stay exact when applied to the pre-aggregated rows. BilledCost itself may only be summed as is
+# (see SUMMED_COST_PATTERN), so round only ever applies to the sum, never to the line items.
+ALLOWED_FUNCTIONS = {"sum", "count", "date_trunc", "coalesce", "round", "lower", "upper", "in"}
+# The only BilledCost measures whose sum over the partial sums equals the sum over the line items
+SUMMED_COST_PATTERN = re.compile(
+    r"\bsum\s*\(\s*(?:BilledCost|coalesce\s*\(\s*BilledCost\s*,\s*0(?:\.0*)?\s*\))\s*\)", re.IGNORECASE
+)
+
+ROLLUP_SELECT = f"""
+    SELECT
+        {", ".join(ROLLUP_DIMENSIONS)},
+        date_trunc('month', BillingPeriodStart::TIMESTAMP) AS BillingPeriodStart,
+        strftime(BillingPeriodStart::TIMESTAMP, '%Y-%m') AS billing_month,
+        SUM(BilledCost) AS BilledCost,
+        COUNT(*) AS line_item_count
+    FROM consolidated_billing
+    {{where}}
+    GROUP BY ALL
+"""
+
+
+def rebuild_rollups(con):
+    """Materializes the whole rollup table from consolidated_billing."""
+    con.execute(f"CREATE OR REPLACE TABLE {ROLLUP_TABLE} AS {ROLLUP_SELECT.format(where='')}")
+    logger.info(f"Rollup {ROLLUP_TABLE} rebuilt with {con.execute(f'SELECT COUNT(*) FROM {ROLLUP_TABLE}').fetchone()[0]} rows.")
+
+
+def refresh_rollup_partitions(con, partitions):
+    """Replaces only the rollup rows of the given (provider, month) partitions. None stands for NULL."""
+    for provider, month in partitions:
+        provider_filter = "ProviderName IS NULL" if provider is None else "ProviderName = $provider"
+        month_filter = "billing_month IS NULL" if month is None else "billing_month = $month"
+        params = {k: v for k, v in (("provider", provider), ("month", month)) if v is not None}
+        con.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE {provider_filter} AND {month_filter}", params)
+        # On the partitioned view the same filters prune every file outside the partition
+        con.execute(
+            f"INSERT INTO {ROLLUP_TABLE} {ROLLUP_SELECT.format(where=f'WHERE {provider_filter} AND {month_filter}')}",
+            params
+        )
+    logger.info(f"Rollup {ROLLUP_TABLE} refreshed for {len(partitions)} partitions.")
+
+
+def _strip_literals(sql):
+    return re.sub(r"'(?:[^']|'')*'", "''", sql)
+
+
+def _billed_cost_only_summed(sql):
+    # The rollup holds partial sums, so every BilledCost reference must be a bare SUM(BilledCost):
+    # abs, round, CASE or arithmetic on the line items before the sum give a different result
+    return not re.search(r"\bBilledCost\b", SUMMED_COST_PATTERN.sub(" ", sql), re.IGNORECASE)
+
+
+def can_use_rollup(sql):
+    """Returns True when the query yields the same result on the rollup as on the raw line items."""
+    stripped = _strip_literals(sql)
+    lowered = stripped.lower()
+    if len(re.findall(r"\bfrom\s+consolidated_billing\b", lowered)) != 1:
+        return False
+    if re.search(r"\b(join|union|intersect|except|with|over)\b", lowered) or lowered.count("select") != 1:
+        return False
+    if "*" in stripped:
+        return False
+    identifiers = set(re.findall(r"\b[a-z_][a-z0-9_]*\b", lowered))
+    if (identifiers & RAW_COLUMNS) - ROLLUP_COLUMNS:
+        return False
+    functions = set(f.lower() for f in re.findall(r"\b(\w+)\s*\(", stripped))
+    if functions - ALLOWED_FUNCTIONS:
+        return False
+    if re.search(r"\bcount\s*\(\s*(?!distinct\b)", lowered):
+        return False
+    if not _billed_cost_only_summed(stripped):
+        return False
+    # BillingPeriodStart is month-truncated: only month-aligned >= / < bounds and date_trunc('month', ...) stay exact
+    for match in re.finditer(r"\bBillingPeriodStart\b", sql, re.IGNORECASE):
+        before = re.sub(r"\s+", "", sql[:match.start()]).lower()
+        after = sql[match.end():]
+        if before.endswith("date_trunc('month',"):
+            continue
+        bound = re.match(r"\s*(>=|<)\s*'(\d{4})-(\d{2})-(\d{2})'", after)
+        if not bound or bound.group(4) != "01":
+            return False
+    return True
+
+
+def route_query(sql):
+    """Rewrites the query to read from the rollup table when that gives an identical answer."""
+    if not sql or not can_use_rollup(sql):
+        return sql
+    routed = re.sub(r"\bconsolidated_billing\b", ROLLUP_TABLE, sql, flags=re.IGNORECASE)
+    logger.info(f"Query routed to {ROLLUP_TABLE}")
+    return routed
@@ -0,0 +1,118 @@
+import json
+import logging
+import math
+import re
+import threading
+from contextlib import contextmanager
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+# Checks for generated SQL before it runs. DuckDB's own parser splits and serializes the statement: only a
+# single SELECT over the allowed tables passes, without table functions (read_csv, pragmas, ...). EXPLAIN then
+# estimates the rows of every plan operator: plans above max_plan_rows are rejected, and non-aggregated
+# queries expected to return more than limit_rows without a LIMIT get one.
+LIMIT_MODIFIERS = {"LIMIT_MODIFIER", "LIMIT_PERCENT_MODIFIER"}
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+def _walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from _walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from _walk(value)
+
+
+def _check_tables(tree, allowed_tables):
+    cte_names = {entry["key"].lower() for node in _walk(tree) if "cte_map" in node for entry in node["cte_map"].get("map", [])}
+    for node in _walk(tree):
+        if node.get("type") == "TABLE_FUNCTION":
+            return f"table function {node['function'].get('function_name')} is not allowed"
+        if node.get("type") == "BASE_TABLE":
+            table = node["table_name"].lower()
+            if table not in allowed_tables and table not in cte_names:
+                return f"table {node['table_name']} is not allowed"
+    return None
+
+
+def _plan_rows(node, estimates):
+    # Rows estimated by the optimizer; cross products carry no estimate, so their children are multiplied
+    children = [_plan_rows(child, estimates) for child in node.get("children", [])]
+    extra_info = node.get("extra_info")
+    estimate = extra_info.get("Estimated Cardinality") if isinstance(extra_info, dict) else None
+    digits = re.sub(r"\D", "", str(estimate or ""))
+    if digits:
+        rows = int(digits)
+    elif node.get("name") == "CROSS_PRODUCT" and children:
+        rows = math.prod(children)
+    else:
+        rows = max(children, default=0)
+    estimates.append((node.get("name", ""), rows))
+    return rows
+
+
+def check_query(con, sql_query, allowed_tables, max_plan_rows, limit_rows):
+    """Validates sql_query on con. Returns (sql, error, action): the SQL to run (with a LIMIT added when
+    action is 'limited'), or error with the reason it was rejected and action 'rejected'."""
+    try:
+        statements = duckdb.extract_statements(sql_query)
+        if len(statements) != 1:
+            return None, f"expected one statement, got {len(statements)}", "rejected"
+        statement = statements[0]
+        if statement.type != duckdb.StatementType.SELECT:
+            return None, f"{statement.type.name} statements are not allowed", "rejected"
+        tree = json.loads(con.execute("SELECT json_serialize_sql(?)", [statement.query]).fetchone()[0])
+        if tree.get("error"):
+            return None, tree.get("error_message", "query could not be parsed"), "rejected"
+        error = _check_tables(tree, {table.lower() for table in allowed_tables})
+        if error:
+            return None, error, "rejected"
+        plan = json.loads(con.execute(f"EXPLAIN (FORMAT JSON) {statement.query}").fetchall()[0][1])
+        estimates = []
+        result_rows = _plan_rows(plan[0], estimates)
+        operator, peak_rows = max(estimates, key=lambda estimate: estimate[1])
+        if peak_rows > max_plan_rows:
+            return None, f"estimated {peak_rows:,} rows at {operator} exceed the limit of {max_plan_rows:,}", "rejected"
+        aggregated = any("GROUP_BY" in name or "AGGREGATE" in name for name, _ in estimates)
+        has_limit = any(modifier.get("type") in LIMIT_MODIFIERS for modifier in tree["statements"][0]["node"].get("modifiers", []))
+        if not aggregated and not has_limit and result_rows > limit_rows:
+            # New lines keep a trailing comment of the statement from swallowing the closing parenthesis
+            logger.info(f"Query estimated at {result_rows:,} rows without aggregation; limited to {limit_rows:,}")
+            return f"SELECT * FROM (\n{statement.query}\n) AS guarded_query LIMIT {int(limit_rows)}", None, "limited"
+        return sql_query, None, "passed"
+    except duckdb.Error as e:
+        return None, str(e), "rejected"
+
+
+@contextmanager
+def query_timeout(con, seconds):
+    """Interrupts the query running on con after seconds and raises QueryTimeout in its place.
+    con must be a cursor of its own, since interrupt cancels whatever runs on it."""
+    if not seconds:
+        yield
+        return
+    timed_out = threading.Event()
+
+    def interrupt():
+        timed_out.set()
+        con.interrupt()
+
+    timer = threading.Timer(seconds, interrupt)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    except Exception as e:
+        # Interrupted fetches surface as InterruptException or, from an Arrow reader, as OSError
+        if timed_out.is_set():
+            raise QueryTimeout(f"query cancelled after {seconds} seconds") from e
+        raise
+    finally:
+        timer.cancel()
@@ -0,0 +1,146 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Deterministic Text-to-SQL for the canonical question shapes listed in sql_prompt_template.
+# Questions containing words outside the vocabulary below get a low confidence and go to the LLM.
+DIMENSION_WORDS = {
+    "provider": "ProviderName", "providers": "ProviderName",
+    "service": "ServiceName", "services": "ServiceName",
+    "category": "ServiceCategory", "categories": "ServiceCategory",
+    "region": "RegionId", "regions": "RegionId",
+    "application": "tag_application", "applications": "tag_application", "app": "tag_application", "apps": "tag_application",
+    "environment": "tag_environment", "environments": "tag_environment",
+    "business unit": "tag_business_unit", "business units": "tag_business_unit",
+}
+SINGULAR_DIMENSION_WORDS = {"provider", "service", "category", "region", "application", "app", "environment", "business unit"}
+RANKING_WORDS = {"top", "most", "main", "highest", "biggest", "largest", "consumers"}
+COST_WORDS = {"cost", "costs", "consumption", "consumed", "consume", "consuming", "spend", "spent", "spending", "billed", "bill", "expenses", "amount"}
+TREND_PATTERN = re.compile(r"\bmonth[- ]over[- ]month\b|\btrends?\b|\bmonthly\b|\b(?:by|per|each) month\b|\bcomparison\b")
+TREND_WORDS = {"month", "over", "trend", "trends", "monthly", "each", "comparison"}
+STOPWORDS = {
+    "what", "whats", "is", "was", "the", "of", "in", "on", "for", "did", "do", "does", "we", "us", "our", "how", "much",
+    "which", "who", "a", "an", "and", "by", "per", "to", "are", "were", "me", "show", "give", "list", "all", "with",
+    "from", "at", "cloud", "has", "have", "tell", "please", "total", "overall", "so", "far", "i", "my", "there",
+}
+NUMBER_WORDS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+MONTH_WORDS = {"january", "february", "march", "april", "may", "june", "july", "august", "september", "october", "november", "december"}
+
+LIMIT_PATTERN = re.compile(r"\btop\s+(\d+|" + "|".join(NUMBER_WORDS) + r")\b")
+
+# Base confidence per shape; each unrecognized word halves it
+SHAPE_CONFIDENCE = {"trend": 0.95, "ranking": 0.9, "grouping": 0.9, "filtered": 0.95, "total": 0.95}
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _where_clause(filters, period):
+    clauses = []
+    for column, values in filters.items():
+        if len(values) == 1:
+            clauses.append(f"{column} = {_quote(values[0])}")
+        else:
+            clauses.append(f"{column} IN ({', '.join(_quote(v) for v in values)})")
+    if period:
+        clauses.append(f"BillingPeriodStart >= '{period[0]}' AND BillingPeriodStart < '{period[1]}'")
+    return f" WHERE {' AND '.join(clauses)}" if clauses else ""
+
+
+def _find_dimensions(question):
+    # Longest phrases first so "business units" wins over a bare "units"
+    found = []
+    for word in sorted(DIMENSION_WORDS, key=len, reverse=True):
+        for match in re.finditer(rf"\b{word}\b", question):
+            if not any(start <= match.start() < end for start, end, _ in found):
+                found.append((match.start(), match.end(), word))
+    return sorted(found)
+
+
+def _group_by_dimensions(question, dimensions):
+    # Dimensions introduced by "by"/"per", including those chained with "and" or commas
+    grouped = []
+    for start, _, word in dimensions:
+        prefix = question[:start]
+        if re.search(r"\b(?:by|per)\s+$", prefix) or (grouped and re.search(r"(?:\band|,)\s+$", prefix)):
+            if DIMENSION_WORDS[word] not in grouped:
+                grouped.append(DIMENSION_WORDS[word])
+    return grouped
+
+
+def _requested_limit(question):
+    match = LIMIT_PATTERN.search(question)
+    if not match:
+        return None
+    value = match.group(1)
+    return int(value) if value.isdigit() else NUMBER_WORDS[value]
+
+
+def _unknown_words(question, entities, dimensions, is_trend, columns):
+    covered = question
+    for term in entities.get("terms", []):
+        covered = re.sub(rf"\b{re.escape(term)}\b", " ", covered)
+    # A dimension word is only known when the SQL groups or filters by its column; "list the services"
+    # would otherwise compile to a single total
+    for _, _, word in dimensions:
+        if DIMENSION_WORDS[word] in columns:
+            covered = re.sub(rf"\b{word}\b", " ", covered)
+    # Numbers are only known when they are the requested limit; a year or date left over would be a
+    # filter the template drops, so it counts as unknown and sends the question to the LLM
+    covered = LIMIT_PATTERN.sub(" ", covered, count=1)
+    known = STOPWORDS | COST_WORDS | RANKING_WORDS | MONTH_WORDS | set(NUMBER_WORDS)
+    if is_trend:
+        known |= TREND_WORDS
+    return [token for token in re.findall(r"[a-z0-9]+", covered) if token not in known]
+
+
+def compile_template_sql(question, entities, top_k=3):
+    """Compiles a canonical-shape question into SQL. Returns (sql, confidence, shape) or (None, 0.0, None)."""
+    question = question.lower()
+    filters = entities.get("filters", {})
+    period = entities.get("period")
+    # Several months or a value shared by several columns are left to the LLM
+    if entities.get("month_count", 0) > 1 or entities.get("ambiguous"):
+        return None, 0.0, None
+    dimensions = _find_dimensions(question)
+    is_trend = bool(TREND_PATTERN.search(question))
+    is_ranking = any(re.search(rf"\b{word}\b", question) for word in RANKING_WORDS)
+    group_by = _group_by_dimensions(question, dimensions)
+    where = _where_clause(filters, period)
+    columns_used = set(filters)
+
+    if is_trend:
+        shape = "trend"
+        sql = (f"SELECT date_trunc('month', BillingPeriodStart) AS month, SUM(BilledCost) AS total_cost "
+               f"FROM consolidated_billing{where} GROUP BY date_trunc('month', BillingPeriodStart) ORDER BY month;")
+    elif is_ranking or group_by:
+        if not group_by:
+            if not dimensions:
+                return None, 0.0, None
+            group_by = [DIMENSION_WORDS[dimensions[0][2]]]
+        shape = "ranking" if is_ranking else "grouping"
+        columns_used.update(group_by)
+        columns = ", ".join(group_by)
+        sql = f"SELECT {columns}, SUM(BilledCost) AS total_cost FROM consolidated_billing{where} GROUP BY {columns} ORDER BY total_cost DESC"
+        if is_ranking:
+            limit = _requested_limit(question)
+            if limit is None:
+                singular = any(word in SINGULAR_DIMENSION_WORDS and DIMENSION_WORDS[word] in group_by for _, _, word in dimensions)
+                limit = 1 if singular else top_k
+            sql += f" LIMIT {limit}"
+        sql += ";"
+    elif "ServiceName" in filters or "ServiceCategory" in filters:
+        shape = "filtered"
+        column = "ServiceName" if "ServiceName" in filters else "ServiceCategory"
+        sql = f"SELECT {column}, SUM(BilledCost) AS total_cost FROM consolidated_billing{where} GROUP BY {column};"
+    else:
+        shape = "total"
+        sql = f"SELECT SUM(BilledCost) AS total_cost FROM consolidated_billing{where};"
+
+    unknown = _unknown_words(question, entities, dimensions, is_trend, columns_used)
+    confidence = SHAPE_CONFIDENCE[shape] * (0.5 ** len(unknown))
+    if unknown:
+        logger.info(f"Template SQL ({shape}) has unrecognized words {unknown}; confidence {confidence:.2f}")
+    return sql, confidence, shape
@@ -0,0 +1,220 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lightweight request tracing: a trace groups the nested spans of one request and is handed to the
+# tracer's exporters when its root span ends. Spans opened outside a trace are not recorded.
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, trace, name, parent, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes)
+        self.status = "ok"
+        self.start_time = time.time()
+        self.end_time = None
+        self._start = time.perf_counter()
+        self.duration_ms = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self.end_time = self.start_time + self.duration_ms / 1000
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id, "span_id": self.span_id, "parent_id": self.parent_id,
+            "name": self.name, "start_time": self.start_time, "duration_ms": round(self.duration_ms, 3),
+            "status": self.status, "attributes": self.attributes,
+        }
+
+
+class _Trace:
+    def __init__(self, tracer, trace_id, attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def record(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+@contextmanager
+def _open_span(trace, name, parent, attributes):
+    current = Span(trace, name, parent, {**trace.attributes, **attributes})
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set_attribute("error", str(e))
+        raise
+    finally:
+        current.end()
+        _current_span.reset(token)
+        trace.record(current)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times a nested stage of the current trace. Yields the Span, or None when no trace is active."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _open_span(parent.trace, name, parent, attributes) as current:
+        yield current
+
+
+def traced(name):
+    """Decorator that runs the whole function, sync or async, inside span(name)."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    return _current_span.get()
+
+
+def trace_id_for(request_id):
+    """Uses the request_id as the trace id when it is a UUID, so logs and traces can be joined."""
+    try:
+        return uuid.UUID(str(request_id)).hex
+    except ValueError:
+        return uuid.uuid4().hex
+
+
+class Tracer:
+    """Starts traces and hands their finished spans to the exporters, on the given executor if any."""
+
+    def __init__(self, exporters=None, enabled=True, executor=None):
+        self.exporters = list(exporters or [])
+        self.enabled = enabled
+        self.executor = executor
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    @contextmanager
+    def trace(self, name, request_id=None, **attributes):
+        """Opens the root span of a new trace; nested span() calls are recorded under it."""
+        if not self.enabled or not self.exporters:
+            yield None
+            return
+        if request_id is not None:
+            attributes["request_id"] = request_id
+        current_trace = _Trace(self, trace_id_for(request_id), attributes)
+        try:
+            with _open_span(current_trace, name, None, {}) as root:
+                yield root
+        finally:
+            spans = sorted(current_trace.spans, key=lambda s: s.start_time)
+            if self.executor:
+                self.executor.submit(self._export, spans)
+            else:
+                self._export(spans)
+
+    def _export(self, spans):
+        for exporter in self.exporters:
+            try:
+                exporter.export(spans)
+            except Exception as e:
+                logger.error(f"Error exporting trace with {type(exporter).__name__}: {str(e)}")
+
+
+class ConsoleExporter:
+    """Logs each trace as an indented tree of span durations."""
+
+    def export(self, spans):
+        depth = {}
+        lines = []
+        for s in spans:
+            depth[s.span_id] = depth.get(s.parent_id, -1) + 1
+            lines.append(f"{'  ' * depth[s.span_id]}{s.name}: {s.duration_ms:.1f} ms{' [error]' if s.status == 'error' else ''}")
+        logger.info(f"Trace {spans[0].trace.trace_id if spans else ''}\n" + "\n".join(lines))
+
+
+class JsonLinesExporter:
+    """Appends one JSON object per span to a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict(), default=str) + "\n")
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    return {"stringValue": json.dumps(value, default=str)}
+
+
+class OtlpFileExporter:
+    """Appends one OTLP/JSON ExportTraceServiceRequest per trace to a file, the format read by the
+    OpenTelemetry Collector's otlpjsonfile receiver."""
+
+    def __init__(self, path, service_name="finops-text-to-sql"):
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        otlp_spans = [{
+            "traceId": s.trace.trace_id,
+            "spanId": s.span_id,
+            **({"parentSpanId": s.parent_id} if s.parent_id else {}),
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(int(s.start_time * 1e9)),
+            "endTimeUnixNano": str(int(s.end_time * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attributes.items()],
+            "status": {"code": 2 if s.status == "error" else 1},
+        } for s in spans]
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": otlp_spans}],
+        }]}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(request) + "\n")
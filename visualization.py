@@ -3,8 +3,11 @@ import plotly.express as px
 import pandas as pd
 from datetime import datetime
 import logging
-from langchain_query_EN import process_question
-from data_processing import get_duckdb_connection
+from langchain_query import export_query_result
+from query_service import ServiceBusy, get_service
+from data_processing import get_dataset_version
+from dashboard_data import TREEMAP_OTHER_LABEL
+from dashboard_cache import get_dashboard_panels, get_filter_options, get_treemap_level, start_background_warm
 import os
 import uuid
 
@@ -99,127 +102,97 @@ st.markdown(
     unsafe_allow_html=True
 )
 
-# Function to fetch summary metrics
-@st.cache_data
-def fetch_summary_metrics():
-    con = get_duckdb_connection()
+# Labels of the dashboard filter widgets, by column (see dashboard_data.FILTER_COLUMNS)
+FILTER_LABELS = {
+    "ProviderName": "Provider",
+    "SubAccountName": "Account",
+    "tag_application": "Application",
+    "tag_environment": "Environment",
+    "tag_business_unit": "Business Unit",
+}
+
+# Dashboard panels and treemap views come from the dataset-versioned cache shared by all sessions and
+# processes (dashboard_cache.py); a new dataset version is picked up on the next rerun
+def fetch_dashboard_panels(dataset_version, filters=None):
     try:
-        query = """
-        SELECT
-            SUM(BilledCost) AS total_billed_cost,
-            COUNT(DISTINCT ProviderName) AS provider_count,
-            SUM(CASE WHEN ProviderName = 'AWS' THEN BilledCost ELSE 0 END) AS aws_cost,
-            SUM(CASE WHEN ProviderName = 'Microsoft' THEN BilledCost ELSE 0 END) AS azure_cost,
-            SUM(CASE WHEN ProviderName = 'Oracle' THEN BilledCost ELSE 0 END) AS oracle_cost
-        FROM consolidated_billing
-        """
-        result = con.execute(query).fetchone()
-        total_billed_cost = result[0] if result[0] is not None else 0.0
-        provider_count = result[1] if result[1] is not None else 0
-        aws_cost = result[2] if result[2] is not None else 0.0
-        azure_cost = result[3] if result[3] is not None else 0.0
-        oracle_cost = result[4] if result[4] is not None else 0.0
-        logger.info(f"Summary metrics: Total=${total_billed_cost:,.2f}, Cloud Providers={provider_count}, "
-                    f"AWS=${aws_cost:,.2f}, Azure=${azure_cost:,.2f}, Oracle=${oracle_cost:,.2f}")
-        return total_billed_cost, provider_count, aws_cost, azure_cost, oracle_cost
+        return get_dashboard_panels(filters, dataset_version)
     except Exception as e:
-        logger.error(f"Error fetching summary metrics: {str(e)}")
-        return 0.0, 0, 0.0, 0.0, 0.0
-    finally:
-        con.close()
+        logger.error(f"Error loading dashboard data: {str(e)}")
+        return {}
 
-# Function to fetch data for bar and pie charts
-@st.cache_data
-def fetch_dashboard_data():
-    con = get_duckdb_connection()
+def fetch_filter_options(dataset_version):
     try:
-        # Query for Top 10 ServiceCategory
-        query_service_category = """
-        SELECT
-            ServiceCategory,
-            SUM(BilledCost) AS total_cost
-        FROM consolidated_billing
-        GROUP BY ServiceCategory
-        ORDER BY total_cost DESC
-        LIMIT 10
-        """
-        df_service_category = pd.DataFrame(
-            con.execute(query_service_category).fetchall(),
-            columns=["ServiceCategory", "total_cost"]
-        )
-        
-        # Query for other charts
-        query_others = """
-        SELECT
-            tag_application,
-            tag_environment,
-            tag_business_unit,
-            ProviderName,
-            SUM(BilledCost) AS total_cost
-        FROM consolidated_billing
-        GROUP BY tag_application, tag_environment, tag_business_unit, ProviderName
-        """
-        df_others = pd.DataFrame(
-            con.execute(query_others).fetchall(),
-            columns=["tag_application", "tag_environment", "tag_business_unit", "ProviderName", "total_cost"]
-        )
-        return df_service_category, df_others
+        return get_filter_options(dataset_version)
     except Exception as e:
-        logger.error(f"Error executing consolidated query: {str(e)}")
-        return pd.DataFrame(), pd.DataFrame()
-    finally:
-        con.close()
+        logger.error(f"Error loading filter options: {str(e)}")
+        return {}
 
-# Function to fetch data for the Treemap chart
-@st.cache_data
-def fetch_treemap_data():
-    con = get_duckdb_connection()
+def fetch_treemap_level(dataset_version, path, filters=None):
     try:
-        query_treemap = """
-        SELECT
-            ServiceCategory,
-            ServiceName,
-            ResourceID,
-            SUM(BilledCost) AS total_cost
-        FROM consolidated_billing
-        WHERE ServiceCategory IS NOT NULL AND ServiceName IS NOT NULL AND ResourceID IS NOT NULL
-        GROUP BY ServiceCategory, ServiceName, ResourceID
-        HAVING SUM(BilledCost) > 0
-        """
-        df_treemap = pd.DataFrame(
-            con.execute(query_treemap).fetchall(),
-            columns=["ServiceCategory", "ServiceName", "ResourceID", "total_cost"]
-        )
-        return df_treemap
+        return get_treemap_level(path, filters, dataset_version)
     except Exception as e:
         logger.error(f"Error fetching data for treemap: {str(e)}")
         return pd.DataFrame()
-    finally:
-        con.close()
 
-# Function to get unique ProviderName values (for debugging)
-@st.cache_data
-def load_providers():
-    con = get_duckdb_connection()
+# Global filters in the sidebar; they are pushed down into every panel and treemap query
+def render_filters(options):
+    filters = {}
+    with st.sidebar:
+        st.markdown("### Filters")
+        months = options.get("months", [])
+        if len(months) > 1:
+            first, last = st.select_slider("Billing period", options=months, value=(months[0], months[-1]), key="filter_months")
+            if (first, last) != (months[0], months[-1]):
+                filters["months"] = [first, last]
+        for column, label in FILTER_LABELS.items():
+            filters[column] = st.multiselect(label, options.get(column, []), key=f"filter_{column}")
+    return filters
+
+# One cache warmer per process, shared by every session
+@st.cache_resource
+def start_dashboard_cache_warmer():
+    return start_background_warm()
+
+# Function to compute summary metrics from the dashboard panels. The provider panel ignores the provider
+# filter (it is a facet), so it is narrowed to the selected providers to match the filtered total
+def fetch_summary_metrics(panels, filters=None):
     try:
-        provider_query = "SELECT DISTINCT ProviderName FROM consolidated_billing WHERE ProviderName IS NOT NULL ORDER BY ProviderName"
-        providers = [row[0] for row in con.execute(provider_query).fetchall()]
-        logger.info(f"Unique ProviderName values: {providers}")
-        return providers
+        df_total, df_provider = panels["total"], panels["provider"].dropna(subset=["ProviderName"])
+        selected_providers = (filters or {}).get("ProviderName")
+        if selected_providers:
+            df_provider = df_provider[df_provider["ProviderName"].isin(selected_providers)]
+        provider_costs = dict(zip(df_provider["ProviderName"], df_provider["total_cost"]))
+        total_billed_cost = float(df_total["total_cost"].iloc[0]) if not df_total.empty and pd.notna(df_total["total_cost"].iloc[0]) else 0.0
+        provider_count = len(df_provider)
+        aws_cost = float(provider_costs.get("AWS", 0.0))
+        azure_cost = float(provider_costs.get("Microsoft", 0.0))
+        oracle_cost = float(provider_costs.get("Oracle", 0.0))
+        logger.info(f"Summary metrics: Total=${total_billed_cost:,.2f}, Cloud Providers={provider_count}, "
+                    f"AWS=${aws_cost:,.2f}, Azure=${azure_cost:,.2f}, Oracle=${oracle_cost:,.2f}")
+        return total_billed_cost, provider_count, aws_cost, azure_cost, oracle_cost
     except Exception as e:
-        logger.error(f"Error loading providers: {str(e)}")
-        return []
-    finally:
-        con.close()
+        logger.error(f"Error fetching summary metrics: {str(e)}")
+        return 0.0, 0, 0.0, 0.0, 0.0
 
-# Load providers for debugging
-load_providers()
+start_dashboard_cache_warmer()
+try:
+    dataset_version = get_dataset_version()
+except Exception as e:
+    logger.error(f"Error reading the dataset version: {str(e)}")
+    dataset_version = None
+dashboard_filters = render_filters(fetch_filter_options(dataset_version) if dataset_version else {})
+dashboard_panels = fetch_dashboard_panels(dataset_version, dashboard_filters) if dataset_version else {}
+if dashboard_panels:
+    logger.info(f"Unique ProviderName values: {sorted(dashboard_panels['provider']['ProviderName'].dropna())}")
 
 # Initialize session_state for the chatbot
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
 if 'processing_message_id' not in st.session_state:
     st.session_state.processing_message_id = None
+# Questions are answered by the process-wide query service; this id keys the conversation's context there
+if 'service_session_id' not in st.session_state:
+    st.session_state.service_session_id = str(uuid.uuid4())
 
 # Main layout defined at the beginning to align the chatbot to the top
 col1, col2 = st.columns([7, 3])
@@ -238,7 +211,7 @@ with col1:
         st.markdown("<h1 style='margin-top: 25px; font-size: 24px;'>FOCUS.AI - Cloud Consumption Analysis Framework</h1>", unsafe_allow_html=True)
 
     # Cards for summary metrics
-    total_billed_cost, provider_count, aws_cost, azure_cost, oracle_cost = fetch_summary_metrics()
+    total_billed_cost, provider_count, aws_cost, azure_cost, oracle_cost = fetch_summary_metrics(dashboard_panels, dashboard_filters)
     card_col1, card_col2, card_col3, card_col4, card_col5 = st.columns(5)
     cards_data = {
         "Total Billed Cost": f"${total_billed_cost:,.2f}",
@@ -260,21 +233,20 @@ with col1:
                 unsafe_allow_html=True
             )
 
-    # Load data for charts
-    df_service_category, df_others = fetch_dashboard_data()
-    df_treemap = fetch_treemap_data()
+    # Panels for charts, each already aggregated and ordered by cost
+    df_service_category = dashboard_panels.get("service_category", pd.DataFrame()).head(10)
     
     st.markdown("---") # Visual divider
     st.markdown("📊 Visualizations")
 
-    if df_others is not None and not df_others.empty and df_service_category is not None and not df_service_category.empty:
+    if dashboard_panels and not df_service_category.empty:
         
         # Columns for the bar charts
         bar_col1, bar_col2 = st.columns(2)
 
         with bar_col1:
             st.markdown("Costs by Provider")
-            df_provider = df_others.groupby("ProviderName")["total_cost"].sum().reset_index().sort_values("total_cost", ascending=True)
+            df_provider = dashboard_panels["provider"].sort_values("total_cost", ascending=True)
             if not df_provider.empty:
                 fig_provider = px.bar(df_provider, y="ProviderName", x="total_cost", orientation='h',
                                       labels={"total_cost": "Total Cost (USD)", "ProviderName": "Provider"},
@@ -304,8 +276,7 @@ with col1:
 
         with pie_col1:
             st.markdown("<h6>Costs by Application (Top 10)</h6>", unsafe_allow_html=True)
-            df_app_full = df_others.groupby("tag_application")["total_cost"].sum().reset_index()
-            df_app = df_app_full.sort_values("total_cost", ascending=False).head(10) # Filter Top 10
+            df_app = dashboard_panels["application"].head(10) # Filter Top 10
             if not df_app.empty and df_app['tag_application'].notna().any():
                 fig_app = px.pie(df_app.dropna(subset=['tag_application']), names="tag_application", values="total_cost", hole=0.4,
                                  labels={"total_cost": "Cost (USD)", "tag_application": "Application"})
@@ -321,7 +292,7 @@ with col1:
 
         with pie_col2:
             st.markdown("<h6>Costs by Environment</h6>", unsafe_allow_html=True)
-            df_env = df_others.groupby("tag_environment")["total_cost"].sum().reset_index()
+            df_env = dashboard_panels["environment"]
             if not df_env.empty and df_env['tag_environment'].notna().any():
                 fig_env = px.pie(df_env.dropna(subset=['tag_environment']), names="tag_environment", values="total_cost", hole=0.4,
                                  labels={"total_cost": "Cost (USD)", "tag_environment": "Environment"})
@@ -337,8 +308,7 @@ with col1:
         
         with pie_col3:
             st.markdown("<h6>Costs by Business Unit (Top 10)</h6>", unsafe_allow_html=True)
-            df_bu_full = df_others.groupby("tag_business_unit")["total_cost"].sum().reset_index()
-            df_bu = df_bu_full.sort_values("total_cost", ascending=False).head(10) # Filter Top 10
+            df_bu = dashboard_panels["business_unit"].head(10) # Filter Top 10
             if not df_bu.empty and df_bu['tag_business_unit'].notna().any():
                 fig_bu = px.pie(df_bu.dropna(subset=['tag_business_unit']), names="tag_business_unit", values="total_cost", hole=0.4,
                                  labels={"total_cost": "Cost (USD)", "tag_business_unit": "Business Unit"})
@@ -354,12 +324,25 @@ with col1:
 
         st.markdown("---") # Visual divider
         
-        # Treemap chart for Cost Breakdown
+        # Treemap chart for Cost Breakdown: top children of each node, deeper levels loaded when drilled into
         st.markdown("Cost Breakdown by Service and Resource")
+        drill_col1, drill_col2 = st.columns(2)
+        with drill_col1:
+            categories = list(dashboard_panels["service_category"]["ServiceCategory"].dropna())
+            category = st.selectbox("Drill into category", ["All"] + categories, key="treemap_category")
+        path = () if category == "All" else (category,)
+        df_treemap = fetch_treemap_level(dataset_version, path, dashboard_filters)
+        if path and not df_treemap.empty:
+            with drill_col2:
+                services = [name for name in df_treemap["ServiceName"].dropna().unique() if name != TREEMAP_OTHER_LABEL]
+                service = st.selectbox("Drill into service", ["All"] + services, key=f"treemap_service_{category}")
+            if service != "All":
+                path = (category, service)
+                df_treemap = fetch_treemap_level(dataset_version, path, dashboard_filters)
         if not df_treemap.empty:
             fig_treemap = px.treemap(
                 df_treemap,
-                path=[px.Constant("Total Cost"), 'ServiceCategory', 'ServiceName', 'ResourceID'],
+                path=[px.Constant(" / ".join(path) or "Total Cost")] + [column for column in df_treemap.columns if column != "total_cost"],
                 values='total_cost',
                 labels={'total_cost': 'Total Cost (USD)'},
                 hover_data={'total_cost': ':.2f'}
@@ -381,9 +364,22 @@ with col2:
     # Container for chat history to allow scrolling
     chat_container = st.container()
     with chat_container:
-        for message in st.session_state.chat_history:
+        for index, message in enumerate(st.session_state.chat_history):
+            if message.get("message_id") and message["message_id"] == st.session_state.processing_message_id:
+                continue  # Rendered below while the answer streams in
             with st.chat_message(message["role"]):
                 st.markdown(f'<div class="response-text">{message["content"]}</div>', unsafe_allow_html=True)
+                if message.get("sql"):
+                    with st.expander("SQL"):
+                        st.code(message["sql"], language="sql")
+                    # The answer may come from a capped result; the full result is only generated when downloaded
+                    st.download_button(
+                        "Download full result (CSV)",
+                        data=lambda sql=message["sql"]: export_query_result(sql),
+                        file_name="query_result.csv",
+                        mime="text/csv",
+                        key=f"download_{index}"
+                    )
     
     if question := st.chat_input("Enter your question"):
         st.session_state.chat_history.append({"role": "user", "content": question})
@@ -401,15 +397,42 @@ with col2:
         last_message = st.session_state.chat_history[-1]
         if last_message.get("message_id") == st.session_state.processing_message_id:
             question = st.session_state.chat_history[-2]["content"]
-            with st.spinner("Processing..."):
+            with chat_container, st.chat_message("assistant"):
+                sql_placeholder = st.empty()
+                answer_placeholder = st.empty()
+                answer_placeholder.markdown('<div class="response-text">Processing...</div>', unsafe_allow_html=True)
+                streamed_tokens = []
+
+                # Show the SQL as soon as it is generated and the answer token by token
+                def show_sql(sql_query):
+                    sql_placeholder.code(sql_query, language="sql")
+
+                def show_token(token):
+                    streamed_tokens.append(token)
+                    answer_placeholder.markdown(f'<div class="response-text">{"".join(streamed_tokens)}▌</div>', unsafe_allow_html=True)
+
                 try:
-                    sql_query, response = process_question(question)
+                    # The service answers on its worker pool; its events are rendered here, in the script thread
+                    for kind, value in get_service().stream(question, st.session_state.service_session_id):
+                        if kind == "sql":
+                            show_sql(value)
+                        elif kind == "token":
+                            show_token(value)
+                        else:
+                            sql_query, response = value
                     st.session_state.chat_history[-1] = {
                         "role": "assistant",
-                        "content": response
+                        "content": response,
+                        "sql": sql_query
                     }
                     logger.info(f"Response added to history: {response}")
                     logger.info(f"SQL query generated for '{question}': {sql_query}")
+                except ServiceBusy:
+                    st.session_state.chat_history[-1] = {
+                        "role": "assistant",
+                        "content": "The assistant is busy answering other questions. Please try again in a moment."
+                    }
+                    logger.error(f"Query service busy; question '{question}' was not queued")
                 except Exception as e:
                     error_message = f"Error processing the question: {str(e)}"
                     st.session_state.chat_history[-1] = {